@@ -0,0 +1,382 @@
+"""
+離線效能測試：用固定輸出的假模型取代 Florence-2、LongCLIP、WD14 和美學模型，
+在合成資料集上量測 main_script.py 與 cluster.py 各函數的耗時，不需要權重、GPU 或網路。
+
+用法:
+    python benchmark.py --images 200 --output result.json
+    python benchmark.py --baseline result.json --tolerance 0.2
+    python benchmark.py --only calculate_best_labels pipeline --main_args "--clothtag --autodroptag=0.3"
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shlex
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+import zlib
+
+import numpy as np
+import torch
+from PIL import Image
+
+EMBED_DIM = 768
+FLORENCE_PHRASES = [
+    "A girl with long hair", "She is wearing a white dress", "The background is a blue sky",
+    "She is smiling at the viewer", "There are flowers in the foreground", "The lighting is soft",
+    "She is holding a cup", "The room has a wooden floor", "Her eyes are red", "She has a ribbon in her hair",
+    "The image is drawn in an anime style", "There is a window behind her", "She is sitting on a chair",
+]
+GENERAL_TAGS = [
+    'solo', '1girl', 'smile', 'looking_at_viewer', 'open_mouth', 'simple_background', 'white_background',
+    'upper_body', 'full_body', 'standing', 'sitting', 'outdoors', 'indoors', 'day', 'sky', 'cloud', 'flower',
+    'holding', 'closed_eyes', 'blush', 'lying', 'on_back', 'multiple_girls', '1boy', 'jewelry', 'hand_up',
+]
+
+
+def image_seed(image):
+    """
+    以縮圖內容算出固定的亂數種子，同一張圖每次都得到相同的假輸出
+    """
+    return zlib.crc32(image.convert('RGB').resize((8, 8)).tobytes())
+
+
+class StubBatch(dict):
+    def to(self, *args, **kwargs):
+        return self
+
+
+class StubFlorenceProcessor:
+    """
+    模擬 Florence-2 processor：__call__、batch_decode、post_process_generation 與 tokenizer.pad_token
+    """
+    tokenizer = types.SimpleNamespace(pad_token='<pad>')
+
+    def __call__(self, text=None, images=None, return_tensors=None, padding=None):
+        seeds = torch.tensor([[image_seed(image) % 65536] for image in images], dtype=torch.float32)
+        return StubBatch(input_ids=torch.zeros(len(images), 1, dtype=torch.long), pixel_values=seeds.view(-1, 1, 1, 1))
+
+    def batch_decode(self, generated_ids, skip_special_tokens=False):
+        texts = []
+        for ids in generated_ids.tolist():
+            words = [FLORENCE_PHRASES[i] for i in ids if i >= 0]
+            texts.append('. '.join(words) + '.' + '<pad>' * (len(ids) - len(words)))
+        return texts
+
+    def post_process_generation(self, text, task=None, image_size=None):
+        return {task: text}
+
+
+class StubFlorenceModel:
+    def generate(self, input_ids=None, pixel_values=None, max_new_tokens=None, num_beams=None):
+        outputs = []
+        for seed in pixel_values.float().view(-1).tolist():
+            rng = random.Random(int(seed))
+            count = rng.randint(3, 6)
+            outputs.append(rng.sample(range(len(FLORENCE_PHRASES)), count) + [-1] * (6 - count))
+        return torch.tensor(outputs)
+
+
+class StubClipModel:
+    """
+    模擬 LongCLIP：encode_image 把縮小的像素投影成 768 維，encode_text 以 token 雜湊查表後平均
+    """
+    def __init__(self, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        self.image_projection = torch.randn(3 * 8 * 8, EMBED_DIM, generator=generator)
+        self.token_table = torch.randn(4096, EMBED_DIM, generator=generator)
+
+    def encode_image(self, image_tensor):
+        pooled = torch.nn.functional.adaptive_avg_pool2d(image_tensor.float(), 8).flatten(1)
+        return pooled @ self.image_projection
+
+    def encode_text(self, text_tensor):
+        text_tensor = text_tensor.long()
+        mask = (text_tensor != 0).float().unsqueeze(-1)
+        embeddings = self.token_table[text_tensor % len(self.token_table)]
+        return (embeddings * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
+def stub_clip_preprocess(image):
+    array = np.asarray(image.convert('RGB').resize((224, 224), Image.BILINEAR), dtype=np.float32) / 255
+    return torch.from_numpy(array).permute(2, 0, 1)
+
+
+class StubAestheticPreprocessor:
+    def __call__(self, images=None, return_tensors=None):
+        arrays = [np.asarray(image.convert('RGB').resize((16, 16)), dtype=np.float32) / 255 for image in images]
+        return types.SimpleNamespace(pixel_values=torch.from_numpy(np.stack(arrays)).permute(0, 3, 1, 2))
+
+
+class StubAestheticModel:
+    def __call__(self, pixel_values):
+        return types.SimpleNamespace(logits=4 + 3 * pixel_values.float().mean(dim=(1, 2, 3)).view(-1, 1))
+
+
+def stub_get_wd14_tags(image, character_threshold=0.85, general_threshold=0.35, drop_overlap=False, **kwargs):
+    """
+    模擬 imgutils.tagging.get_wd14_tags，返回 (rating, features, chars)
+    """
+    rng = random.Random(image_seed(image))
+    vocabulary = GENERAL_TAGS + [tag.replace(' ', '_') for tag in stub_tag_pool]
+    features = {tag: round(rng.uniform(general_threshold, 1), 4) for tag in rng.sample(vocabulary, rng.randint(8, 24))}
+    rating = {name: rng.random() for name in ('general', 'sensitive', 'questionable', 'explicit')}
+    chars = {'stub_character_(series)': 0.9} if rng.random() < 0.2 else {}
+    return rating, features, chars
+
+
+stub_tag_pool = []
+
+
+def install_stub_clip_interrogator():
+    """
+    cluster.py 匯入時需要 clip_interrogator (沒有安裝時會用 pip 安裝)，這裡換成不載入任何東西的版本
+    """
+    module = types.ModuleType('clip_interrogator')
+
+    class Config:
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    class Interrogator:
+        def __init__(self, config):
+            self.config = config
+
+    class LabelTable:
+        def __init__(self, labels, desc, ci):
+            self.labels = list(labels)
+            self.embeds = []
+
+    module.Config = Config
+    module.Interrogator = Interrogator
+    module.LabelTable = LabelTable
+    module.load_list = lambda *args, **kwargs: []
+    sys.modules['clip_interrogator'] = module
+
+
+def install_stub_models(main_script, seed):
+    main_script.models['florence'] = (StubFlorenceModel(), StubFlorenceProcessor())
+    main_script.models['clip'] = (StubClipModel(seed), stub_clip_preprocess)
+    main_script.models['aesthetic'] = (StubAestheticModel(), StubAestheticPreprocessor())
+    main_script.get_wd14_tags = stub_get_wd14_tags
+    main_script.wd14_tagger.fallback = True
+    main_script.view_specs.clear()
+    stub_tag_pool[:] = sorted(main_script.chartags | set(main_script.clothing_tags))[:400]
+
+
+def make_dataset(root, folders, images_per_folder, image_size, seed):
+    """
+    產生 N_name 形式的子資料夾，每張圖是固定種子的色塊圖
+    """
+    rng = np.random.default_rng(seed)
+    folder_paths = []
+    for folder_index in range(folders):
+        folder_path = os.path.join(root, f"{folder_index + 1}_character{folder_index}")
+        os.makedirs(folder_path, exist_ok=True)
+        for image_index in range(images_per_folder):
+            blocks = rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+            image = Image.fromarray(blocks).resize((image_size, image_size * 3 // 4), Image.NEAREST)
+            image.save(os.path.join(folder_path, f"{image_index:05d}.jpg"), quality=90)
+        folder_paths.append(folder_path)
+    return folder_paths
+
+
+def write_cluster_captions(folder_path, seed):
+    """
+    為 cluster.py 寫入和 main_script.py 輸出格式相同的 txt
+    """
+    rng = random.Random(seed)
+    for file_name in sorted(os.listdir(folder_path)):
+        if not file_name.endswith('.jpg'):
+            continue
+        tags = ['solo'] + rng.sample(stub_tag_pool, rng.randint(10, 30))
+        if rng.random() < 0.3:
+            tags.append('outdoors')
+        caption = f"a character stub in this image, rating:general, ___{', '.join(tags)}"
+        with open(os.path.join(folder_path, os.path.splitext(file_name)[0] + '.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join([caption, 'inaccurate, ' + caption, 'inaccurate, ' + caption]))
+
+
+def timed(function, repeat, setup=None):
+    """
+    執行 repeat 次並返回每次秒數，setup 不計時
+    """
+    seconds = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def run_benchmarks(args):
+    install_stub_clip_interrogator()
+    import main_script
+    main_script.prefix_clip_labels()
+    install_stub_models(main_script, args.seed)
+
+    work_dir = tempfile.mkdtemp(prefix='dataset_tools_bench_')
+    results = {}
+    try:
+        image_dir = os.path.join(work_dir, 'images')
+        folder_paths = make_dataset(image_dir, args.folders, args.images // args.folders, args.image_size, args.seed)
+        image_paths = [os.path.join(folder_path, name) for folder_path in folder_paths for name in sorted(os.listdir(folder_path))]
+        main_args = main_script.parse_args(shlex.split(args.main_args) + ['--text_cache_dir=', image_dir])
+
+        def reset_text_caches():
+            if args.cold:
+                main_script.text_features_dict = main_script.TextFeatureCache()
+                main_script.label_matrix_cache.clear()
+            random.seed(args.seed)
+
+        # 先把每張圖的 WD14/Florence 結果算好，函數層級的測試只量目標函數本身
+        prepared = []
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            for image_path in image_paths:
+                views = main_script.ImageViews(main_script.resize_image(image_path))
+                rating, features, chars = stub_get_wd14_tags(views.image)
+                processed, _ = main_script.process_features(dict(features))
+                wd14_caption = main_script.tags_to_text(processed, use_escape=False, use_spaces=True)
+                more_detailed_caption, _ = main_script.run_example('<MORE_DETAILED_CAPTION>', views)
+                prepared.append((image_path, views, features, chars, wd14_caption, more_detailed_caption))
+        best_labels = []
+
+        def bench_calculate_best_labels():
+            best_labels.clear()
+            for image_path, views, _, _, wd14_caption, more_detailed_caption in prepared:
+                best_labels.append(main_script.calculate_best_labels(views, wd14_caption, more_detailed_caption, image_path, main_args))
+
+        def bench_process_features():
+            for _, _, features, _, _, _ in prepared:
+                main_script.process_features(dict(features))
+
+        def bench_generate_special_text():
+            for image_path, _, features, chars, _, _ in prepared:
+                main_script.generate_special_text(image_path, main_args, features, chars)
+
+        def bench_folder_drop():
+            if not best_labels:
+                bench_calculate_best_labels()
+            folder_stats = main_script.FolderLabelStats()
+            folder_chartag = {}
+            for (image_path, _, features, chars, _, _), result in zip(prepared, best_labels):
+                folder_stats.add(result[-1][1].float().cpu().numpy().astype(np.float16), result[-1][2])
+                chartags = main_script.generate_special_text(image_path, main_args, features, chars)[1]
+                folder_chartag = main_script.build_folder_chartag(result[0][4], folder_chartag, chartags)
+            tags_to_drop = main_script.features_to_drop(folder_stats, args.drop_percent)
+            if folder_chartag:
+                tags_to_drop |= main_script.chartags_to_drop(folder_chartag)
+            for result in best_labels:
+                main_script.drop_tags_from_caption(result[0][4], tags_to_drop)
+
+        def reset_pipeline():
+            reset_text_caches()
+            for root, _, files in os.walk(image_dir):
+                for file_name in files:
+                    if file_name.endswith('.txt'):
+                        os.remove(os.path.join(root, file_name))
+
+        def bench_pipeline():
+            main_script.find_and_process_images(image_dir, main_args)
+
+        cluster_dir = os.path.join(work_dir, 'cluster')
+        cluster_args = types.SimpleNamespace(
+            folder_name=True, not_char=False, cluster_model_name=args.cluster_model_name, dry_run=False,
+            move_cluster=False, copy_cluster=False, dir_mode='costume', svd_components=args.svd_components,
+        )
+
+        def reset_cluster():
+            shutil.rmtree(cluster_dir, ignore_errors=True)
+            for folder_path in make_dataset(cluster_dir, 1, args.cluster_images, 64, args.seed):
+                write_cluster_captions(folder_path, args.seed)
+
+        def bench_process_subfolder():
+            import cluster
+            cluster.process_subfolder(os.path.join(cluster_dir, '1_character0'), cluster_args)
+
+        benchmarks = {
+            'calculate_best_labels': (bench_calculate_best_labels, reset_text_caches, len(prepared)),
+            'process_features': (bench_process_features, None, len(prepared)),
+            'generate_special_text': (bench_generate_special_text, reset_text_caches, len(prepared)),
+            'folder_drop': (bench_folder_drop, reset_text_caches, len(prepared)),
+            'pipeline': (bench_pipeline, reset_pipeline, len(prepared)),
+            'process_subfolder': (bench_process_subfolder, reset_cluster, args.cluster_images),
+        }
+        for name in args.only or benchmarks:
+            function, setup, items = benchmarks[name]
+            # 第一次呼叫包含 import 與快取建立，不計入
+            timed(function, 1, setup)
+            seconds = timed(function, args.repeat, setup)
+            results[name] = {
+                'items': items,
+                'repeat': args.repeat,
+                'min_seconds': round(min(seconds), 6),
+                'median_seconds': round(statistics.median(seconds), 6),
+                'items_per_second': round(items / statistics.median(seconds), 3) if statistics.median(seconds) > 0 else None,
+            }
+            print(f"{name:24s} {results[name]['median_seconds']:10.4f}s  {results[name]['items_per_second']} items/s")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    """
+    中位數比基準慢超過 tolerance 比例的項目視為退步，返回退步項目名稱
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median_seconds'] / max(baseline[name]['median_seconds'], 1e-9)
+        print(f"{name:24s} {ratio:6.2f}x baseline")
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="以假模型離線量測打標與聚類流程的效能")
+    parser.add_argument("--images", type=int, default=120, help="合成圖片總數")
+    parser.add_argument("--folders", type=int, default=2, help="合成子資料夾數")
+    parser.add_argument("--image_size", type=int, default=768, help="合成圖片寬度")
+    parser.add_argument("--cluster_images", type=int, default=300, help="process_subfolder 測試用的圖片數")
+    parser.add_argument("--cluster_model_name", type=str, default='Agglomerative層次聚類', help="process_subfolder 使用的聚類模型")
+    parser.add_argument("--svd_components", type=int, default=100, help="process_subfolder 的 TruncatedSVD 維度，0 為不降維")
+    parser.add_argument("--drop_percent", type=float, default=0.3, help="features_to_drop 的比例")
+    parser.add_argument("--repeat", type=int, default=3, help="每項重複次數，取中位數")
+    parser.add_argument("--seed", type=int, default=0, help="合成資料與假模型的亂數種子")
+    parser.add_argument("--cold", action="store_true", help="每次重複前清空文字特徵快取")
+    parser.add_argument("--main_args", type=str, default="", help="傳給 main_script.py 的參數，例如 \"--clothtag --autodroptag=0.3\"")
+    parser.add_argument("--only", nargs="+", choices=['calculate_best_labels', 'process_features', 'generate_special_text', 'folder_drop', 'pipeline', 'process_subfolder'], help="只跑指定項目")
+    parser.add_argument("--output", type=str, default=None, help="結果寫成 JSON 檔")
+    parser.add_argument("--baseline", type=str, default=None, help="與先前的 JSON 結果比較，有退步時結束碼為 1")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許比基準慢的比例")
+    args = parser.parse_args(argv)
+    args.folders = max(1, min(args.folders, args.images))
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.tolerance)
+        if regressions:
+            print(f"效能退步: {', '.join(regressions)}")
+            sys.exit(1)
@@ -4,6 +4,8 @@ import platform
 import argparse
 import requests
 import sys
+import json
+import socket
 
 def download_file(url, filename):
     try:
@@ -26,6 +28,25 @@ def run_setup_script():
     if not os.path.exists(main_script_filename) or args.upgrade:
         subprocess.run([sys.executable, setup_filename], check=True)
 
+def submit_to_worker(command_args, port):
+    """
+    常駐 worker 有在執行時把任務交給它並等待完成，沒有 worker 時返回 False
+    """
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=2)
+    except OSError:
+        return False
+    print(f"交給常駐 worker 處理 (127.0.0.1:{port})")
+    with sock:
+        sock.settimeout(None)
+        sock.sendall((json.dumps({'argv': command_args}, ensure_ascii=False) + '\n').encode('utf-8'))
+        response = sock.makefile('r', encoding='utf-8').readline()
+    response = json.loads(response) if response else {'status': 'error', 'message': 'worker 中斷連線'}
+    if response.get('status') != 'done':
+        print(f"worker 處理失敗: {response.get('message')}")
+        sys.exit(1)
+    return True
+
 def run_main_script_in_venv(args):
     main_script_url = "https://raw.githubusercontent.com/gesen2egee/dataset_tools/main/main_script.py"
     main_script_filename = "main_script.py"
@@ -33,13 +54,18 @@ def run_main_script_in_venv(args):
     if not os.path.exists(main_script_filename) or args.upgrade:
         download_file(main_script_url, main_script_filename)
 
+    # main_script.py 依賴的模組
+    for module_filename in ["tag_rules.py"]:
+        if not os.path.exists(module_filename) or args.upgrade:
+            download_file(f"https://raw.githubusercontent.com/gesen2egee/dataset_tools/main/{module_filename}", module_filename)
+
     if platform.system() == 'Windows':
         activate_script = os.path.join('venv', 'Scripts', 'activate.bat')
     else:
         activate_script = os.path.join('venv', 'bin', 'activate')
 
     command_args = [
-        args.directory,
+        os.path.abspath(args.directory) if args.directory else "",
         "--folder_name" if args.folder_name else "",
         "--drop_chartag" if args.drop_chartag else "",
         "--drop_colortag" if args.drop_colortag else "",
@@ -49,14 +75,31 @@ def run_main_script_in_venv(args):
         "--debiased" if args.debiased else "",
         "--rawdata" if args.rawdata else "",
         "--clustertag" if args.clustertag else "",
-        f"--custom_keeptag=\"{args.custom_keeptag}\"" if args.custom_keeptag else "",
-        f"--continue_caption {args.continue_caption}" if args.continue_caption else "",
-        f"--autodroptag {args.autodroptag}" if args.autodroptag else ""
+        "--unordered_pairs" if args.unordered_pairs else "",
+        "--skip_florence" if args.skip_florence else "",
+        "--incremental" if args.incremental else "",
+        f"--accuracy_cutoff={args.accuracy_cutoff}" if args.accuracy_cutoff != "minmax" else "",
+        "--skip_aesthetic" if args.skip_aesthetic else "",
+        f"--custom_keeptag={args.custom_keeptag}" if args.custom_keeptag else "",
+        f"--continue_caption={args.continue_caption}" if args.continue_caption else "",
+        f"--autodroptag={args.autodroptag}" if args.autodroptag else "",
+        f"--caption_batch_size={args.caption_batch_size}" if args.caption_batch_size != 1 else "",
+        f"--wd14_batch_size={args.wd14_batch_size}" if args.wd14_batch_size != 1 else "",
+        f"--aes_batch_size={args.aes_batch_size}" if args.aes_batch_size != 1 else "",
+        f"--clip_batch_size={args.clip_batch_size}" if args.clip_batch_size != 1 else "",
+        f"--decode_workers={args.decode_workers}" if args.decode_workers != 4 else "",
+        f"--profile={os.path.abspath(args.profile)}" if args.profile else "",
+        f"--trace={os.path.abspath(args.trace)}" if args.trace else ""
     ]
 
     # 过滤掉空字符串
     command_args = [arg for arg in command_args if arg]
 
+    if args.start_worker:
+        command_args = ["--serve", f"--port={args.worker_port}"]
+    elif submit_to_worker(command_args, args.worker_port):
+        return
+
     if os.name == 'nt':
         command = f"{activate_script} && python {main_script_filename} " + subprocess.list2cmdline(command_args)
     else:
@@ -79,8 +122,24 @@ if __name__ == "__main__":
     parser.add_argument("--upgrade", action="store_true", help="升級腳本")
     parser.add_argument("--clustertag", action="store_true", help="對標籤聚類")
     parser.add_argument("--autodroptag", type=float, default=0, help="自動刪標，刪除跟資料集太接近的標，小數點是比例")
-    parser.add_argument("directory", type=str, help="處理目錄地址")
+    parser.add_argument("--unordered_pairs", action="store_true", help="候選標籤組合不分先後，只算一半組合，更快但結果可能略有不同")
+    parser.add_argument("--accuracy_cutoff", choices=["minmax", "percentile"], default="minmax", help="accuracy 標的門檻：minmax 依分數範圍，percentile 依分數分布百分位")
+    parser.add_argument("--incremental", action="store_true", help="依圖片內容雜湊只處理新增或修改過的圖片")
+    parser.add_argument("--skip_florence", action="store_true", help="不跑 Florence-2 自然語言標")
+    parser.add_argument("--skip_aesthetic", action="store_true", help="不跑美學模型")
+    parser.add_argument("--caption_batch_size", type=int, default=1, help="Florence-2 每批次打標圖片數")
+    parser.add_argument("--wd14_batch_size", type=int, default=1, help="WD14 tagger 每批次圖片數")
+    parser.add_argument("--aes_batch_size", type=int, default=1, help="美學模型每批次圖片數")
+    parser.add_argument("--clip_batch_size", type=int, default=1, help="LongCLIP 圖片編碼每批次圖片數")
+    parser.add_argument("--decode_workers", type=int, default=4, help="讀圖縮圖執行緒數")
+    parser.add_argument("--profile", type=str, default=None, help="把各 stage 的耗時、每秒張數與記憶體高點寫成 JSON 檔")
+    parser.add_argument("--trace", type=str, default=None, help="把各 stage 的時間軸寫成 Chrome trace 檔")
+    parser.add_argument("--start_worker", action="store_true", help="啟動常駐 worker，之後的 caption.py 會直接把任務交給它")
+    parser.add_argument("--worker_port", type=int, default=7865, help="常駐 worker 的本機埠號")
+    parser.add_argument("directory", type=str, nargs="?", help="處理目錄地址")
     args = parser.parse_args()
+    if not args.start_worker and not args.directory:
+        parser.error("需要處理目錄地址")
 
     run_setup_script()
     run_main_script_in_venv(args)
@@ -13,7 +13,11 @@ import random
 from io import BytesIO
 from datetime import datetime, timedelta
 import fnmatch
+import threading
 import torch
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import repeat
 
 # 自動安裝所需庫
 def install_and_import(package):
@@ -43,6 +47,19 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 from natsort import natsorted
 import pandas as pd
+try:
+    from tag_rules import TagRules
+except ImportError:
+    # 單獨下載 cluster.py 時旁邊沒有 tag_rules.py，退回合併成一個正則的簡易版 (無精確比對與快取，結果相同)
+    class TagRules:
+        def __init__(self, patterns, flags=0):
+            self.regex = re.compile('|'.join(f'(?:{pattern})' for pattern in patterns), flags)
+
+        def matches(self, tag):
+            return self.regex.match(tag) is not None
+
+        def search(self, text):
+            return self.regex.search(text) is not None
 
 
 try:
@@ -104,6 +121,9 @@ patterns_to_keep = [
     r'^.*photo.*$', r'^.*full_body.*$'
 ]
 
+keep_tag_rules = TagRules(patterns_to_keep)
+nsfw_tag_rules = TagRules(['.*nude.*$', '.*penis.*$', '.*nipple.*$', '.*anus.*$', '.*sex.*$'], flags=re.IGNORECASE)
+
 clip_adj= [
     'friendly', 'charismatic', 'honest', 'calm', 'independent', 'optimistic', 'generous', 'lively', 'disciplined', 'compassionate', 'hardworking', 'innovative', 'ambitious', 'bold', 'creative', 'outgoing', 'humble', 'selfless', 'practical', 'enthusiastic', 'dependable', 'reliable', 'easygoing', 'assertive', 'responsible', 'considerate', 'cheerful', 'rational', 'analytical', 'insightful', 'open-minded', 'extroverted', 'intelligent', 'confident', 'amiable', 'flexible', 'conscientious', 'authentic', 'fair', 'self-confident', 'skilled', 'gracious', 'diligent', 'positive', 'charming', 'resourceful', 'professional', 'passionate', 'coherent', 'logical', 'empathetic', 'curious', 'immature', 'candid', 'patient', 'genuine', 'kind', 'loyal', 'persistent', 'athletic', 'brave', 'average', 'sociable', 'decisive', 'determined', 'adaptable', 'talented', 'energetic', 'understanding', 'forgiving', 'perceptive', 'tolerant', 'versatile', 'caring', 'fearless', 'trustworthy', 'persevering', 'consistent', 'witty', 'persuasive', 'sensational', 'engaging', 'astute', 'self-disciplined', 'sincere', 'thoughtful', 'wise', 'active', 'adventurous', 'diplomatic', 'gregarious', 'impolite', 'imaginative', 'discreet', 'circumspect', 'neat', 'polite', 'mature', 'sympathetic', 'motivated', 'popular', 'lucky', 'loving', 'nice', 'gentle', 'posh', 'secure', 'good', 'helpful', 'funny', 'intuitive', 'willing', 'powerful', 'realistic', 'inspiring', 'plucky', 'affable', 'communicative', 'composed', 'dynamic', 'amusing', 'meticulous', 'aware', 'careful', 'amicable', 'sassy', 'courteous', 'courageous', 'sappy', 'sardonic', 'faithful', 'humorous', 'bright', 'antisocial', 'annoying', 'shameful', 'belligerent', 'tidy', 'inventive', 'smart', 'joyful', 'antsy', 'sensible', 'romantic', 'sheepish', 'abrasive', 'hopeful', 'complex', 'shameless', 'impressionable', 'irreverent', 'forceful', 'businesslike', 'idiosyncratic', 'intellectual', 'adversarial', 'rebellious', 'silly', 'surprising', 'political', 'outspoken', 'sarcastic', 'unyielding', 'quiet', 'inhibited', 'enigmatic', 'cerebral', 'childlike', 'ethical', 'competitive', 'noncompetitive', 'opportunistic', 'decisive', 'modern', 'shy', 'philosophical', 'mischievous', 'basic', 'introverted', 'relaxed', 'moralistic', 'perfectionist', 'exuberant', 'martyr', 'folksy', 'solemn', 'neutral', 'sensitive', 'straightforward', 'noncommittal', 'unique', 'extravagant', 'casual', 'cultured', 'breezy', 'emotional', 'impartial', 'private', 'unchanging', 'sentimental', 'frugal', 'barbarous', 'soft', 'subservient', 'tough', 'dignified', 'undemanding', 'cautious', 'conservative', 'frank', 'compatible', 'intense', 'mercurial', 'modest', 'ordinary', 'predictable', 'questioning', 'uncompromising', 'reserved', 'timid', 'serious', 'unassuming', 'strict', 'aggressive', 'confrontational', 'devious', 'cocky', 'ignorant', 'forgetful', 'gossipy', 'irrational', 'gullible', 'judgmental', 'pessimistic', 'sleazy', 'prejudiced', 'unmotivated', 'mean', 'argumentative', 'cruel', 'defensive', 'morbid', 'resentful', 'stingy', 'rude', 'obsessive', 'impractical', 'disloyal', 'apologizing', 'disrespectful', 'bossy', 'catty', 'egotistical', 'awkward', 'deceitful', 'dishonest', 'bad', 'evil', 'flaky', 'humorless', 'manipulative', 'nosy', 'petty', 'reckless', 'stupid', 'untidy', 'apathetic', 'boring', 'callous', 'childish', 'cowardly', 'cynical', 'dense', 'dim', 'disorganized', 'disruptive', 'evasive', 'fanatical', 'foolish', 'frivolous', 'greedy', 'grumpy', 'hostile', 'impatient', 'inconsiderate', 'jealous', 'lazy', 'moody', 'nasty', 'stubborn', 'paranoid', 'possessive', 'pretentious', 'rotten', 'selfish', 'spoiled', 'unlucky', 'unreliable', 'vain', 'happy', 'sad', 'angry', 'anxious', 'frustrated', 'sorry', 'ashamed', 'frightened', 'disappointed', 'confused', 'lonely', 'afraid', 'hot', 'crazy', 'withdrawn', 'depressed', 'guilty', 'proud', 'hungry', 'scared', 'excited', 'content', 'bored', 'embarrassed', 'interested', 'thirsty', 'puzzled', 'hurt', 'smug', 'suspicious', 'touching', 'fearful', 'surprised', 'envious', 'nostalgic', 'amused', 'grateful', 'loved', 'miserable', 'regretful', 'sick', 'indifferent', 'enraged', 'pained', 'relieved', 'disgusted', 'ecstatic', 'nervous', 'shocked', 'sleepy', 'skeptical', 'worried', 'attractive', 'dashing', 'fashionable', 'stunning', 'exquisite', 'stylish', 'aesthetic', 'gorgeous', 'trendy', 'lovely', 'handsome', 'radiant', 'beautiful', 'cute', 'pretty', 'alluring', 'striking', 'sophisticated', 'sumptuous', 'elegant', 'classy', 'petite', 'elderly', 'plump', 'thin', 'fat', 'slim', 'well-built', 'stocky', 'slender', 'short', 'chubby', 'stunted', 'ornate', 'stout', 'centenarian', 'youthful', 'spry', 'tall', 'aged', 'venerable', 'ageless', 'muscular', 'lanky', 'octogenarian', 'medium-height', 'stumpy', 'long-lived', 'curvy', 'skinny', 'square', 'rectangular', 'circular', 'round', 'oval', 'flat', 'triangular', 'elliptical', 'spherical', 'symmetrical', 'asymmetrical', 'angular', 'linear', 'humongous', 'conical', 'irregular', 'geometric', 'convex', 'wavy', 'curved', 'twisted', 'cylindrical', 'pyramidal', 'bent', 'blunt', 'straight', 'wide', 'colossal', 'jagged', 'thick', 'substantial', 'narrow', 'microscopic', 'massive', 'oversized', 'snug', 'undersized', 'compact', 'bulky', 'pointed', 'concave', 'gigantic', 'tiny', 'coarse', 'meager', 'stubby', 'roomy', 'fine', 'minuscule', 'large', 'spiky', 'wet', 'bumpy', 'numb', 'blue', 'red', 'black', 'white', 'green', 'pink', 'purple', 'yellow', 'orange', 'brown', 'gray', 'silver', 'lavender', 'turquoise', 'golden', 'magenta', 'teal', 'violet', 'mauve', 'plum', 'lilac', 'indigo', 'bronze', 'cyan', 'navy blue', 'burgundy', 'cherry', 'crimson', 'maroon', 'scarlet', 'cream', 'chartreuse', 'coral', 'salmon', 'olive', 'emerald', 'beige', 'ivory', 'eggshell', 'bone', 'amazing', 'superb', 'exceptional', 'impeccable', 'wonderful', 'supreme', 'phenomenal', 'fabulous', 'astonishing', 'polished', 'magnificent', 'terrific', 'flawless', 'marvelous', 'premium', 'spectacular', 'enchanting', 'stable', 'splendid', 'outstanding', 'majestic', 'incredible', 'heavenly', 'comfortable', 'extraordinary', 'excellent', 'delightful', 'accessible', 'accurate', 'enjoyable', 'frequent', 'occasional', 'constant', 'recurring', 'sporadic', 'continuous', 'repeated', 'regular', 'periodic', 'infrequent', 'intermittent', 'prompt', 'chronic', 'rare', 'young', 'old', 'future', 'past', 'new', 'ancient', 'timeless', 'contemporary', 'current', 'historic', 'vintage', 'antique', 'spicy', 'delicious', 'sweet', 'salty', 'savory', 'nutty', 'tart', 'yummy', 'bland', 'fluffy', 'zesty', 'peppery', 'sinful', 'refreshing', 'crispy', 'tacit', 'buttery', 'decadent', 'robust', 'eggy', 'crumbly', 'juicy', 'bitter', 'piquant', 'astringent', 'delectable', 'high', 'fishy', 'citrusy', 'flavorful', 'saccharine', 'delicate', 'comforting', 'squeaky', 'creamy', 'smoky', 'moist', 'glazed', 'tasty', 'chunky', 'silky', 'pickled', 'fruity', 'fiery', 'honeyed', 'gummy', 'acidic', 'sour', 'refined', 'sizzling', 'rich', 'tangy', 'earthy', 'airy', 'runny', 'velvety', 'melty', 'doughy', 'crunchy', 'leathery', 'chewy', 'mild', 'loud', 'musical', 'melodic', 'roaring', 'dissonant', 'buzzing', 'noisy', 'riotous', 'harmonious', 'raucous', 'whistling', 'mellow', 'humming', 'muted', 'thundering', 'noiseless', 'peaceful', 'rowdy', 'resounding', 'penetrating', 'silent', 'voiceless', 'husky', 'dull', 'jarring', 'subtle', 'muffled', 'speechless', 'percussive', 'pleasing', 'tumultuous', 'deafening', 'gruff', 'rhythmic', 'vocal', 'soundless', 'tranquil', 'glaring', 'unspoken', 'brassy', 'crackling', 'thunderous', 'mute', 'mellifluous', 'vociferous', 'boisterous', 'resonant', 'howling', 'strident', 'screaming', 'tuneful', 'uproarious', 'howling', 'faint', 'rasping', 'croaky', 'raucous', 'discordant', 'piercing', 'shrill', 'screechy', 'insistent', 'pulsating', 'piercing', 'sharp', 'screeching', 'voiced', 'unvoiced', 'clamorous', 'echoing', 'grating', 'audible', 'inaudible', 'grinding', 'monotonous', 'smooth', 'rough', 'shiny', 'synthetic', 'fabric', 'plastic', 'durable', 'heavy', 'ceramic', 'fragile', 'soft', 'porous', 'non-porous', 'brittle', 'matte', 'sticky', 'textured', 'supple', 'lightweight', 'elastic', 'leather', 'natural', 'resilient', 'sturdy', 'opaque', 'spongy', 'tender', 'glass', 'wooden', 'damp', 'warm', 'dry', 'slimy', 'firm', 'cold', 'slick', 'fragrant', 'aromatic', 'antiseptic', 'floral', 'acrid', 'clean', 'rancid', 'foul', 'fetid', 'perfumed', 'evocative', 'funky', 'bouquet', 'pungent', 'frowsty', 'musky', 'scented', 'fusty', 'malodorous', 'musty', 'stuffy', 'overpowering', 'herbal', 'woody', 'flowery', 'nauseating', 'putrid', 'minty', 'lemony', 'sickly', 'peachy', 'coppery', 'garlicky', 'stale', 'ambrosial', 'sunny', 'windy', 'chilly', 'overcast', 'showery', 'icy', 'cloudy', 'clear', 'rainy', 'humid', 'stormy', 'bleak', 'snowy', 'dreary', 'scorching', 'freezing', 'inclement', 'hazy', 'tropical', 'misty', 'foggy', 'clement', 'muggy', 'frosty', 'gloomy', 'scalding', 'cloudless', 'blistering', 'balmy', 'biting', 'brisk', 'temperate', 'windless', 'gusty', 'murky', 'threatening', 'torrential', 'northern', 'southern', 'eastern', 'western', 'northwestern', 'northeastern', 'southwestern', 'southeastern', 'far', 'close', 'near', 'distant', 'inaccessible', 'remote', 'rural', 'suburban', 'urban', 'central', 'peripheral', 'coastal', 'inland', 'galactic', 'adjacent', 'isolated', 'landlocked', 'orbital', 'untouchable', 'continental', 'intercontinental', 'cosmic', 'strong', 'fierce', 'overwhelming', 'dramatic', 'concentrated', 'entertaining', 'fast', 'harsh', 'mighty', 'custom', 'explosive', 'informative', 'electric', 'relevant', 'transparent', 'ferocious', 'vigorous', 'severe', 'convenient', 'potent', 'recyclable', 'maintainable', 'extreme', 'quick', 'concise', 'expert', 'graceful', 'sluggish', 'lavish', 'simple', 'agile', 'clumsy', 'stiff', 'slow', 'jerky', 'regenerative', 'nimble', 'shuffling', 'swift', 'flowing', 'bouncy', 'indigenous', 'fitting', 'foolproof', 'foreign', 'ethnic', 'homegrown', 'regional', 'cosmopolitan', 'multicultural', 'traditional', 'national', 'international', 'alien', 'native', 'immigrant', 'domestic', 'imported', 'aborigine', 'heritage', 'exotic', 'factual', 'priceless', 'local', 'impoverished', 'disadvantaged', 'accomplished', 'precious', 'satisfactory', 'respected', 'safe', 'significant', 'destitute', 'successful', 'anonymous', 'influential', 'acrobatic', 'privileged', 'cherished', 'rarefied', 'underprivileged', 'reversible', 'honored', 'scalable', 'wealthy', 'prosperous', 'disrespected', 'deprived', 'affluent', 'sustainable', 'poor', 'renewable', 'unaccomplished', 'lush', 'unsuccessful', 'opulent', 'elite', 'powerless', 'needy', 'reputable', 'tasteful', 'functional', 'utilitarian', 'productive', 'uncomplicated', 'purposeful', 'intentional', 'valuable', 'invaluable', 'vivid', 'irreplaceable', 'healthy', 'esteemed', 'compliant', 'exclusive', 'costly', 'uniform', 'coveted', 'homogeneous', 'ambiguous', 'luxurious', 'worthwhile', 'expensive', 'compelling', 'constructive', 'horrendous', 'beneficial', 'profitable', 'tactical', 'abandoned', 'balanced', 'beneficent', 'usable', 'advantageous', 'effective', 'serviceable', 'picturesque', 'reusable', 'strategic', 'abhorrent', 'efficient', 'useful', 'precise', 'magical', 'striped', 'responsive', 'handy', 'abnormal', 'plaid', 'groggy', 'notable', 'spotted', 'variegated', 'suitable', 'timely', 'personalized', 'checkered', 'hurtful', 'abstract', 'instrumental', 'meaningful', 'extensible', 'scandalous', 'hygienic', 'tartan', 'dotted', 'marbled', 'secretive', 'paisley', 'atrocious', 'scientific', 'scholarly', 'idyllic', 'seamless', 'illogical'
 ]
@@ -147,7 +167,19 @@ class CustomInterrogate(Interrogator):
 
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-ci = CustomInterrogate(Config(device=device,caption_model_name=None,clip_model_name='ViT-L-14/datacomp_xl_s13b_b90k'))
+interrogator = None
+interrogator_lock = threading.Lock()
+
+def get_interrogator() -> CustomInterrogate:
+    """
+    首次使用時才載入 CLIP Interrogator (ViT-L-14)。
+    聚類流程用不到它，匯入 cluster.py (包括 --workers 的子行程重新匯入) 時不會載入模型。
+    """
+    global interrogator
+    with interrogator_lock:
+        if interrogator is None:
+            interrogator = CustomInterrogate(Config(device=device,caption_model_name=None,clip_model_name='ViT-L-14/datacomp_xl_s13b_b90k'))
+    return interrogator
 
 
 def _merge_tables(tables: List[LabelTable], ci: Interrogator) -> LabelTable:
@@ -172,17 +204,52 @@ def _truncate_to_fit(text: str, tokenize) -> str:
 
 def process_clustering(image_info_list: List[Dict[str, Optional[str]]], tags_list, n_clusters, cluster_prefix, args):
 
-    def extract_text_features(tags_list: List[str]) -> Tuple[np.ndarray, List[str]]:
+    def extract_text_features(tags_list: List[str]) -> Tuple["csr_matrix", List[str]]:
+        """TF-IDF 保持稀疏 (每列已 L2 正規化)，不轉成圖片數 × 標籤數的稠密矩陣"""
         from sklearn.feature_extraction.text import TfidfVectorizer
         vectorizer = TfidfVectorizer(tokenizer=lambda x: x.split(', '), token_pattern=None)
-        X = vectorizer.fit_transform(tags_list).toarray()
+        X = vectorizer.fit_transform(tags_list).tocsr()
         feature_names = vectorizer.get_feature_names_out().tolist()
         return X, feature_names
 
+    def reduce_features(X, n_components: int) -> np.ndarray:
+        """
+        以 TruncatedSVD 把稀疏 TF-IDF 降到 n_components 維後再 L2 正規化 (LSA)，聚類只在這個小的稠密矩陣上做。
+        圖片數或標籤數不超過 n_components (或 n_components 為 0) 時直接用正規化的 TF-IDF 本身。
+        """
+        from sklearn.decomposition import TruncatedSVD
+        from sklearn.preprocessing import normalize
+        if n_components <= 0 or min(X.shape) <= n_components:
+            return X.toarray()
+        X_reduced = TruncatedSVD(n_components=n_components, random_state=0).fit_transform(X)
+        return normalize(X_reduced)
+
+    def two_level_clustering(X: np.ndarray, n_clusters: int, max_micro_clusters: int = 4096) -> np.ndarray:
+        """
+        先用 MiniBatchKMeans 把圖片分成微聚類，再對微聚類中心做 cosine/average 的層次聚類，每張圖取所屬微聚類的結果。
+        記憶體與時間約為 O(圖片數 × 微聚類數 + 微聚類數²)，不再是圖片數的平方。
+        圖片數不超過微聚類數時直接對圖片做層次聚類，結果與 Agglomerative層次聚類 相同。
+        MiniBatchKMeans 和 TruncatedSVD 一樣固定 random_state，同一份資料每次的聚類結果相同。
+        """
+        from sklearn.cluster import MiniBatchKMeans, AgglomerativeClustering
+        n_micro_clusters = min(max_micro_clusters, 10 * n_clusters)
+        if len(X) <= n_micro_clusters:
+            return AgglomerativeClustering(n_clusters=n_clusters, metric='cosine', linkage='average').fit_predict(X)
+        micro = MiniBatchKMeans(n_clusters=n_micro_clusters, n_init=1, batch_size=max(4096, n_micro_clusters), random_state=0).fit(X)
+        macro = AgglomerativeClustering(n_clusters=n_clusters, metric='cosine', linkage='average').fit_predict(micro.cluster_centers_)
+        # 沒分到圖片的微聚類會讓部分聚類編號空掉，重新編成連續的 0..k-1
+        return np.unique(macro[micro.labels_], return_inverse=True)[1]
+
     def perform_clustering(X: np.ndarray, n_clusters: int, model_name: str) -> np.ndarray:
-        from sklearn.cluster import KMeans, SpectralClustering, AgglomerativeClustering, OPTICS
+        from sklearn.cluster import KMeans, MiniBatchKMeans, SpectralClustering, AgglomerativeClustering, OPTICS
         if model_name == "K-Means聚類":
             model = KMeans(n_clusters=n_clusters, n_init=8)
+        elif model_name == "MiniBatchKMeans聚類":
+            # 可能有聚類沒分到圖片，標籤重新編成連續的 0..k-1
+            labels = MiniBatchKMeans(n_clusters=n_clusters, n_init=3, batch_size=4096, random_state=0).fit_predict(X)
+            return np.unique(labels, return_inverse=True)[1]
+        elif model_name == "兩階段聚類":
+            return two_level_clustering(X, n_clusters)
         elif model_name == "Spectral譜聚類":
             model = SpectralClustering(n_clusters=n_clusters, affinity='cosine')
         elif model_name == "Agglomerative層次聚類":
@@ -193,33 +260,60 @@ def process_clustering(image_info_list: List[Dict[str, Optional[str]]], tags_lis
             raise ValueError(f"不支持的聚類模型: {model_name}")
         return model.fit_predict(X)
 
-    def cluster_feature_analysis(X: np.ndarray, y_pred: np.ndarray, feature_names: List[str], clusters_ID: np.ndarray) -> List[dict]:
-        from sklearn.feature_selection import SelectKBest, chi2
-        import pandas as pd
+    def cluster_feature_analysis(X, y_pred: np.ndarray, feature_names: List[str], clusters_ID: np.ndarray, block_size: int = 64) -> List[dict]:
+        """
+        一次算出所有聚類的 chi2 分數與標籤平均，不再逐聚類跑 SelectKBest(chi2) + pandas。
+        稀疏的聚類指示矩陣 (聚類 × 圖片) 乘上 X 得到各聚類內的標籤總和，聚類外的總和由全體總和相減，
+        分數算式同 sklearn 的 chi2 (該聚類 vs 其他)，前 k 名與 SelectKBest 一樣用穩定排序挑選，
+        平均值排序同 nlargest 保留先出現者。聚類按 block_size 分塊，稠密的中間結果只有 block_size × 標籤數。
+        """
+        from scipy.sparse import csr_matrix
+        # X - X.min(axis=0)：只有每張圖都有的標籤最小值不為 0，這些欄位每列都有存值，直接從 data 扣掉即可保持稀疏
+        X_shifted = X.copy()
+        X_shifted.data -= X.min(axis=0).toarray().ravel()[X_shifted.indices]
+        X_shifted.eliminate_zeros()
+        n_samples, n_features = X_shifted.shape
+        k = min(10, n_features)
+        feature_names = np.array(feature_names)
+        feature_count = np.asarray(X_shifted.sum(axis=0)).ravel()
+
+        # 依聚類穩定排序圖片索引，每個聚類的成員是 order 中連續的一段且維持原本的圖片順序
+        rows = np.searchsorted(clusters_ID, y_pred)
+        order = np.argsort(rows, kind='stable')
+        counts = np.bincount(rows, minlength=len(clusters_ID))
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+
         cluster_feature_tags_list = []
-        for i in tqdm(clusters_ID, desc="分析聚類特徵"):
-            temp_pred = y_pred.copy()
-            temp_pred[temp_pred != i] = i + 1
-            k = min(10, X.shape[1])
-            selector = SelectKBest(chi2, k=k)
-            X_shifted = X - X.min(axis=0)
-            X_selected = selector.fit_transform(X_shifted, temp_pred)
-            X_selected_index = selector.get_support(indices=True)
-            tags_selected = np.array(feature_names)[X_selected_index]
-            cluster_df = pd.DataFrame(X_shifted[temp_pred == i], columns=feature_names)
-            cluster_tags_df = cluster_df.iloc[:, X_selected_index]
-            mean_values = cluster_tags_df.mean(axis=0)
-            prompt_tags_list = mean_values.nlargest(10).index.tolist()
-            cluster_feature_tags_list.append({"prompt": prompt_tags_list})
+        for start in tqdm(range(0, len(clusters_ID), block_size), desc="分析聚類特徵"):
+            stop = min(start + block_size, len(clusters_ID))
+            block_counts = counts[start:stop]
+            block_order = order[indptr[start]:indptr[stop]]
+            block_indptr = indptr[start:stop + 1] - indptr[start]
+            indicator = csr_matrix((np.ones(len(block_order)), block_order, block_indptr), shape=(stop - start, n_samples))
+
+            observed_in = (indicator @ X_shifted).toarray()
+            observed_out = feature_count - observed_in
+            expected_in = (block_counts / n_samples)[:, None] * feature_count
+            expected_out = ((n_samples - block_counts) / n_samples)[:, None] * feature_count
+            with np.errstate(invalid='ignore', divide='ignore'):
+                scores = (observed_in - expected_in) ** 2 / expected_in + (observed_out - expected_out) ** 2 / expected_out
+            scores[np.isnan(scores)] = np.finfo(scores.dtype).min
+            selected = np.sort(np.argsort(scores, axis=1, kind='mergesort')[:, -k:], axis=1)
+
+            # 聚類內平均只算被選中的欄位，先乘 1/n 再加總，與稀疏矩陣的 mean 相同
+            columns, selected_columns = np.unique(selected, return_inverse=True)
+            scaled = csr_matrix((np.repeat(1.0 / block_counts, block_counts), block_order, block_indptr), shape=indicator.shape)
+            means = (scaled @ X_shifted[:, columns]).toarray()
+            selected_means = np.take_along_axis(means, selected_columns.reshape(selected.shape), axis=1)
+
+            for feature_index, mean_values in zip(selected, selected_means):
+                ranked = np.argsort(-mean_values, kind='stable')[:10]
+                cluster_feature_tags_list.append({"prompt": feature_names[feature_index[ranked]].tolist()})
         return cluster_feature_tags_list
 
     def is_nsfw(tags: str) -> bool:
         """檢查標籤是否符合 NSFW 黑名單"""
-        nsfw_blacklist = ['.*nude.*$', '.*penis.*$', '.*nipple.*$', '.*anus.*$', '.*sex.*$']
-        for pattern in nsfw_blacklist:
-            if re.search(pattern, tags, re.IGNORECASE):
-                return True
-        return False
+        return nsfw_tag_rules.search(tags)
         
     def is_clustering(tags: str, input_set: Set[str]) -> bool:
         tags_list = tags.split(', ')
@@ -229,31 +323,37 @@ def process_clustering(image_info_list: List[Dict[str, Optional[str]]], tags_lis
             return True
         return False
 
-    def update_clusters(image_info_list: List[Dict[str, Optional[str]]], y_pred: np.ndarray, cluster_feature_tags_list: List[dict], cluster_prefix: str):
+    def update_clusters(image_info_list: List[Dict[str, Optional[str]]], y_pred: np.ndarray, cluster_feature_tags_list: List[dict], cluster_prefix: str) -> Dict[str, dict]:
+        """
+        依 y_pred 一次分組出每個聚類的圖片索引，按張數由多到少命名為 {cluster_prefix}a~z (超過 26 個的不命名)，
+        一次寫回每張圖的聚類名稱與提示詞。返回有名稱的聚類 {名稱: {'prompt': 提示詞, 'images': [image_info, ...]}}
+        """
         cluster_counts = np.bincount(y_pred)
-        non_empty_clusters = [i for i in range(len(cluster_counts))]
-        sorted_clusters = sorted(non_empty_clusters, key=lambda x: cluster_counts[x], reverse=True)
+        # 穩定排序後每個聚類的成員是連續的一段，且維持 image_info_list 的順序
+        cluster_members = np.split(np.argsort(y_pred, kind='stable'), np.cumsum(cluster_counts)[:-1])
+        sorted_clusters = sorted(range(len(cluster_counts)), key=lambda x: cluster_counts[x], reverse=True)
 
+        named_clusters = {}
         for idx, cluster_id in enumerate(sorted_clusters):
-            nsfw = False
             cluster_prompt = ', '.join(cluster_feature_tags_list[cluster_id]['prompt'])
-            cluster_name = 'no'
-            if idx < 26:
-                cluster_name = f"{cluster_prefix}{chr(97 + idx)}"
-
-            for image_info in image_info_list:
-                if y_pred[image_info_list.index(image_info)] == cluster_id:
-                    if cluster_name != 'no':
-                        image_info[f'{cluster_prefix}cluster_name'] = cluster_name
-                    image_info[f'{cluster_prefix}cluster_prompt'] = cluster_prompt
+            cluster_name = f"{cluster_prefix}{chr(97 + idx)}" if idx < 26 else None
+            images = [image_info_list[i] for i in cluster_members[cluster_id]]
+            for image_info in images:
+                if cluster_name is not None:
+                    image_info[f'{cluster_prefix}cluster_name'] = cluster_name
+                image_info[f'{cluster_prefix}cluster_prompt'] = cluster_prompt
+            if cluster_name is not None:
+                named_clusters[cluster_name] = {'prompt': cluster_prompt, 'images': images}
+        return named_clusters
             
     X, feature_names = extract_text_features(tags_list)
     if len(tags_list) > 0:
-        y_pred = perform_clustering(X, n_clusters, args.cluster_model_name)
+        y_pred = perform_clustering(reduce_features(X, args.svd_components), n_clusters, args.cluster_model_name)
         clusters_ID = np.unique(y_pred)
         cluster_feature_tags_list = cluster_feature_analysis(X, y_pred, feature_names, clusters_ID)
 
-        update_clusters(image_info_list, y_pred, cluster_feature_tags_list, cluster_prefix)
+        return update_clusters(image_info_list, y_pred, cluster_feature_tags_list, cluster_prefix)
+    return {}
 
 def process_image(image_path, args):
     def resize_image(image_path, max_size=512):
@@ -368,12 +468,10 @@ def process_image(image_path, args):
         keys = list(features.keys())
         keys_to_delete = []
 
-        for pattern in patterns_to_keep:
-            regex = re.compile(pattern)
-            for key in keys:
-                if regex.match(key):
-                    keep_tags_set.add(key.replace('_', ' '))
-                    keys_to_delete.append(key)
+        for key in keys:
+            if keep_tag_rules.matches(key):
+                keep_tags_set.add(key.replace('_', ' '))
+                keys_to_delete.append(key)
         
         for key in keys_to_delete:
             if key in features:
@@ -411,7 +509,11 @@ def process_image(image_path, args):
 
 
 
-def process_subfolder(subfolder_path: str, args, md_filepath: str):
+def process_subfolder(subfolder_path: str, args) -> Optional[str]:
+    """
+    聚類一個子資料夾並修改文本、移動或複製檔案，返回它在 cluster_results.md 中的段落，跳過的資料夾返回 None。
+    不寫入共用的檔案，可以在多個行程中同時處理不同的子資料夾。
+    """
 
     def read_images_and_tags(images_dir: str, file_ext: str = '.txt') -> List[Dict[str, Optional[str]]]:
 
@@ -508,7 +610,7 @@ def process_subfolder(subfolder_path: str, args, md_filepath: str):
                 else:
                     new_caption += f'{tag}, '
                     
-#        cluster_text += f"{ci.custom_interrogate_fast(image=Image.open(info['path']), caption=cluster_text)}, "
+#        cluster_text += f"{get_interrogator().custom_interrogate_fast(image=Image.open(info['path']), caption=cluster_text)}, "
 #
         for i in range(len(lines)):
             if i < 3:
@@ -526,18 +628,12 @@ def process_subfolder(subfolder_path: str, args, md_filepath: str):
         with open(txt_filepath, 'w', encoding='utf-8') as file:
             file.write('\n'.join(lines))
         
-    def copy_or_move_clusters(subfolder_path: str, subfolder_name: str, image_info_list: List[Dict[str, Optional[str]]], repeats: int, name_from_folder: str, args):
-        cluster_images = {}
-        for info in image_info_list:
-            cluster_name = info[f'{args.dir_mode}_cluster_name'] 
-            if cluster_name:
-                if cluster_name not in cluster_images:
-                    cluster_images[cluster_name] = []
-                cluster_images[cluster_name].append(info['path'])
+    def copy_or_move_clusters(subfolder_path: str, subfolder_name: str, clusters: Dict[str, Dict[str, dict]], image_count: int, repeats: int, name_from_folder: str, args):
+        cluster_images = {cluster_name: [info['path'] for info in cluster['images']] for cluster_name, cluster in clusters.get(f'{args.dir_mode}_', {}).items()}
 
         # 計算每個聚類要複製幾份
         max_cluster_size = max(len(images) for images in cluster_images.values())
-        num_subfolder_images = len(image_info_list) * repeats
+        num_subfolder_images = image_count * repeats
         extra_repeats = max(1, int(math.ceil(num_subfolder_images / (max_cluster_size * len(cluster_images)))))
 
         for cluster_name, images in tqdm(cluster_images.items(), desc="移動或複製檔案"):
@@ -621,38 +717,27 @@ def process_subfolder(subfolder_path: str, args, md_filepath: str):
                     except FileNotFoundError as e:
                         print(f"文件未找到: {e.filename}")
 
-    def write_cluster_results_to_md(md_filepath: str, subfolder_path: str, image_info_list: List[Dict[str, Optional[str]]]):
-        with open(md_filepath, 'a', encoding='utf-8') as md_file:
-            md_file.write(f"# 聚類結果 - {subfolder_path}\n")
-            md_file.write(f"總圖片數: {len(image_info_list)}\n")
-            clusters = {}
-            clusters_prompts = []
-            cluster_prefixes = ['costume_', 'appearance_', 'scene_']
-            for cluster_prefix in cluster_prefixes:
-                for info in image_info_list:
-                    if info[f'{cluster_prefix}cluster_name'] is not None:
-                        if info[f'{cluster_prefix}cluster_name'] not in clusters:
-                            clusters[info[f'{cluster_prefix}cluster_name']] = {
-                                'count': 0,
-                                'prompt': info[f'{cluster_prefix}cluster_prompt']
-                            }
-                        clusters[info[f'{cluster_prefix}cluster_name']]['count'] += 1
-                        
-
-            # 排序非 None 的聚類名
-            sorted_cluster_names = natsorted(clusters.keys())
-            print("\n")
-            for cluster_name in sorted_cluster_names:
-                cluster_data = clusters[cluster_name]
-                print(f"最終聚類名稱: {cluster_name}")
-                print(f"聚類標籤: {cluster_name}, {cluster_data['prompt']}")
-                print(f"聚類張數: {cluster_data['count']}")
-                print("")    
-                md_file.write(f"## {cluster_name}\n")
-                md_file.write(f"{cluster_name}, {cluster_data['prompt']}\n")
-                md_file.write(f"聚類張數: {cluster_data['count']}\n")
-                md_file.write("\n")
-                clusters_prompts.append(cluster_data['prompt'])
+    def format_cluster_results(subfolder_path: str, clusters: Dict[str, Dict[str, dict]], image_count: int) -> str:
+        """產生這個子資料夾在 cluster_results.md 中的段落"""
+        lines = [f"# 聚類結果 - {subfolder_path}\n", f"總圖片數: {image_count}\n"]
+        named_clusters = {}
+        for prefix_clusters in clusters.values():
+            named_clusters.update(prefix_clusters)
+
+        # 排序非 None 的聚類名
+        sorted_cluster_names = natsorted(named_clusters.keys())
+        print("\n")
+        for cluster_name in sorted_cluster_names:
+            cluster_data = named_clusters[cluster_name]
+            print(f"最終聚類名稱: {cluster_name}")
+            print(f"聚類標籤: {cluster_name}, {cluster_data['prompt']}")
+            print(f"聚類張數: {len(cluster_data['images'])}")
+            print("")    
+            lines.append(f"## {cluster_name}\n")
+            lines.append(f"{cluster_name}, {cluster_data['prompt']}\n")
+            lines.append(f"聚類張數: {len(cluster_data['images'])}\n")
+            lines.append("\n")
+        return ''.join(lines)
                 
     subfolder_name = os.path.basename(subfolder_path)
     if "_" not in subfolder_name or not subfolder_name.split("_")[0].isdigit() or ' extra ' in subfolder_name:
@@ -687,59 +772,75 @@ def process_subfolder(subfolder_path: str, args, md_filepath: str):
         return
 
     print("開始聚類...")
+    # {聚類前綴: {聚類名稱: {'prompt', 'images'}}}，供移動/複製檔案與寫入報告使用
+    clusters = {}
     
     costume_info_list = [info for info in image_info_list if 'solo' in info['all_tags'] and 'completely nude' not in info['all_tags']]
     costume_tags_list = [info['costume'] for info in costume_info_list]
     n_clusters = min(300, math.ceil(len(costume_info_list) / 5) + 1)
     if len(costume_tags_list) > 0:
-        process_clustering(costume_info_list, costume_tags_list, n_clusters, 'costume_', args)
+        clusters['costume_'] = process_clustering(costume_info_list, costume_tags_list, n_clusters, 'costume_', args)
         print("服裝聚類完成")
 
     appearance_info_list = [info for info in image_info_list if 'doors' in info['all_tags'] and 'solo' in info['all_tags'] and info['costume_cluster_name'] is None]
     appearance_tags_list = [info['appearance'] for info in appearance_info_list]
     n_clusters = min(300, math.ceil(len(appearance_info_list) / 5) + 1)
     if len(appearance_tags_list) > 0:
-        process_clustering(appearance_info_list, appearance_tags_list, n_clusters, 'appearance_', args)
+        clusters['appearance_'] = process_clustering(appearance_info_list, appearance_tags_list, n_clusters, 'appearance_', args)
         print("外型聚類完成")
         
     scene_info_list = [info for info in image_info_list if info['costume_cluster_name'] is None and info['appearance_cluster_name'] is None]
     scene_tags_list = [info['scene'] for info in scene_info_list]
     n_clusters = min(300, math.ceil(len(scene_info_list) / 5) + 1)     
     if len(scene_tags_list) > 0:        
-        process_clustering(scene_info_list, scene_tags_list, n_clusters, 'scene_', args)
+        clusters['scene_'] = process_clustering(scene_info_list, scene_tags_list, n_clusters, 'scene_', args)
         print("場景聚類完成")
         
     if not args.dry_run:
         for info in tqdm(image_info_list, desc="修改文本"):
             insert_cluster_text_to_txt(info, args)
 
-    copy_or_move_clusters(subfolder_path, subfolder_name, image_info_list, repeats, name_from_folder, args)
+    copy_or_move_clusters(subfolder_path, subfolder_name, clusters, len(image_info_list), repeats, name_from_folder, args)
+
+    return format_cluster_results(subfolder_path, clusters, len(image_info_list))
 
-    write_cluster_results_to_md(md_filepath, subfolder_path, image_info_list)
+def limit_worker_threads(threads: int):
+    """平行處理子資料夾時限制每個行程的 BLAS/OpenMP 執行緒數，避免 KMeans 等在多個行程中搶同一批核心"""
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=threads)
 
 def main():
     parser = argparse.ArgumentParser(description="聚類分析腳本")
     parser.add_argument("--folder_name", action="store_true", help="啟用特殊資料夾名稱處理")
     parser.add_argument("--not_char", action="store_true", help="非角色")
-    parser.add_argument('--cluster_model_name', choices=['K-Means聚類', 'Spectral譜聚類', 'Agglomerative層次聚類', 'OPTICS聚類'], default='Agglomerative層次聚類', help='聚類模型名稱')
+    parser.add_argument('--cluster_model_name', choices=['K-Means聚類', 'MiniBatchKMeans聚類', '兩階段聚類', 'Spectral譜聚類', 'Agglomerative層次聚類', 'OPTICS聚類'], default='Agglomerative層次聚類', help='聚類模型名稱，圖片很多的資料夾用 MiniBatchKMeans聚類 或 兩階段聚類 (KMeans 微聚類 + 層次聚類)')
     parser.add_argument('--dry_run', action='store_true', help='不輸出文本')
     parser.add_argument('--move_cluster', action='store_true', help='移動到子資料夾的聚類文件夾')
     parser.add_argument('--copy_cluster', action='store_true', help='複製到子資料夾的extra文件夾')
+    parser.add_argument('--svd_components', type=int, default=100, help='TF-IDF 以 TruncatedSVD 降到幾維再聚類，0 為不降維')
+    parser.add_argument('--workers', type=int, default=1, help='同時處理幾個子資料夾 (行程數)，1 為依序處理')
     parser.add_argument('--dir_mode', choices=['costume', 'appearance', 'scene'], default='costume', help='檔案模式：依照服裝、外表或場景聚類服裝')
     args = parser.parse_args()
     
     parent_dir = os.path.dirname(os.path.abspath(__file__))
-    subfolders = [f.path for f in os.scandir(parent_dir) if f.is_dir()]
+    subfolders = natsorted(f.path for f in os.scandir(parent_dir) if f.is_dir())
 
     md_filepath = os.path.join(parent_dir, "cluster_results.md")
-    with open(md_filepath, 'w', encoding='utf-8') as md_file:
+    with open(md_filepath, 'w', encoding='utf-8') as md_file, ExitStack() as stack:
         md_file.write("# 聚類結果\n\n")      
 
-    for subfolder in subfolders:
-        #try:
-        process_subfolder(subfolder, args, md_filepath)
-        #except:
-        #    print(f"{subfolders}處理出錯 略過")
+        if args.workers > 1:
+            threads = max(1, (os.cpu_count() or 1) // args.workers)
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=args.workers, initializer=limit_worker_threads, initargs=(threads,)))
+            sections = pool.map(process_subfolder, subfolders, repeat(args))
+        else:
+            sections = (process_subfolder(subfolder, args) for subfolder in subfolders)
+
+        # 依子資料夾的 natsorted 順序寫入，平行處理時報告與依序處理相同
+        for section in sections:
+            if section:
+                md_file.write(section)
+                md_file.flush()
 
 
 if __name__ == "__main__":
@@ -27,22 +27,250 @@ from imgutils.tagging import get_wd14_tags, tags_to_text, drop_blacklisted_tags,
 from imgutils.validate import anime_dbrating
 import traceback
 import json
+import hashlib
+import tempfile
+import inspect
+import queue
+import threading
+import socketserver
+import time
+from contextlib import contextmanager
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from aesthetic_predictor_v2_5 import convert_v2_5_from_siglip
 import faiss
 import numpy as np
+from tag_rules import TagRules
+try:
+    import psutil
+except ImportError:
+    # 只有 --profile 在非 Linux 平台量記憶體高點時需要
+    psutil = None
 
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# longclip.load 在 GPU 上是 fp16，CPU 上轉成 fp32
+clip_dtype = torch.float16 if device.type == 'cuda' else torch.float32
 model_id = 'microsoft/Florence-2-large'
-model = AutoModelForCausalLM.from_pretrained(model_id, trust_remote_code=True).eval().to(device).half()
-processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
 p = inflect.engine()
-clip_model, clip_preprocess = longclip.load("./checkpoints/Long-ViT-L-14-GmP-ft-state_dict.pt", device=device)
-aes_model, aes_preprocessor = convert_v2_5_from_siglip(
-    low_cpu_mem_usage=True,
-    trust_remote_code=True,
-)
-aes_model = aes_model.to(torch.bfloat16).to(device)
+clip_checkpoint = "./checkpoints/Long-ViT-L-14-GmP-ft-state_dict.pt"
+models = {}
+model_lock = threading.Lock()
+
+class StageProfiler:
+    """
+    記錄管線各 stage 的耗時、處理張數與記憶體高點，輸出 JSON 摘要與 Chrome trace (chrome://tracing、Perfetto 可開)。
+    未啟用時 stage() 不做任何事。GPU stage 結束時會同步 CUDA，因此開啟後整體會略慢。
+    巢狀的 stage (例如 label_selection 內的 clip_text) 時間會同時算進兩者。
+    peak_rss 是 stage 執行期間的常駐記憶體高點 (含期間已釋放的配置)，不同執行緒同時在跑的 stage 會拿到同一個高點。
+    Linux 讀 VmHWM 並重設，其他平台 (Windows、macOS) 需安裝 psutil，改由背景執行緒每 10ms 取樣 rss，比這更短的暫時配置可能量不到。
+    兩者都無法使用時摘要的 peak_rss.note 會註明原因。
+    """
+    rss_sample_interval = 0.01
+    rss_notes = {
+        'vmhwm': 'Linux VmHWM，每個 stage 開始時重設',
+        'psutil': 'psutil 每 10ms 取樣 rss，更短的暫時配置可能量不到',
+        'vmhwm_lifetime': 'Linux VmHWM 無法重設 (/proc/self/clear_refs 不可寫)，為行程至今的高點；安裝 psutil 可改為取樣',
+        None: '無法取得：非 Linux 平台需要 pip install psutil',
+    }
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.sampler_stop = None
+        self.reset()
+
+    def reset(self, enabled=False):
+        if self.sampler_stop is not None:
+            self.sampler_stop.set()
+            self.sampler_stop = None
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.events = []
+        self.stats = {}
+        # 進行中的 stage 各自的記憶體高點
+        self.active_peaks = {}
+        self.rss_method = self.detect_rss_method() if enabled else None
+        if self.rss_method == 'psutil':
+            self.process = psutil.Process()
+            self.sampler_stop = threading.Event()
+            threading.Thread(target=self._sample_rss, args=(self.sampler_stop,), daemon=True).start()
+
+    @staticmethod
+    def detect_rss_method():
+        """
+        返回量記憶體高點的方式：'vmhwm' (Linux，可重設)、'psutil' (背景取樣)、'vmhwm_lifetime' (Linux 無法重設且沒有 psutil) 或 None
+        """
+        try:
+            with open('/proc/self/status') as f:
+                has_vmhwm = any(line.startswith('VmHWM:') for line in f)
+        except OSError:
+            has_vmhwm = False
+        if has_vmhwm:
+            try:
+                with open('/proc/self/clear_refs', 'w') as f:
+                    f.write('5')
+                return 'vmhwm'
+            except OSError:
+                pass
+        if psutil is not None:
+            return 'psutil'
+        return 'vmhwm_lifetime' if has_vmhwm else None
+
+    @staticmethod
+    def take_peak_rss():
+        """
+        讀取行程常駐記憶體的高點 (/proc/self/status 的 VmHWM, bytes) 後重設為目前用量 (/proc/self/clear_refs, Linux 4.0+)，
+        因此返回的是上一次呼叫以來的高點，包含期間已釋放的暫時配置。無法重設時為整個行程至今的高點，非 Linux 取不到時為 None
+        """
+        try:
+            with open('/proc/self/status') as f:
+                peak = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:'))
+        except (OSError, ValueError, StopIteration):
+            return None
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+        return peak
+
+    def _sample_rss(self, stop_event):
+        """
+        psutil 模式的背景取樣執行緒，有進行中的 stage 時才讀 rss
+        """
+        while not stop_event.wait(self.rss_sample_interval):
+            with self.lock:
+                if self.active_peaks and not stop_event.is_set():
+                    self._fold_peak_rss()
+
+    def _fold_peak_rss(self):
+        """
+        把上次讀取以來的記憶體高點算進每個進行中的 stage，巢狀或同時在跑的 stage 都會拿到這段時間的高點。須持有 self.lock
+        """
+        if self.rss_method == 'psutil':
+            try:
+                peak = self.process.memory_info().rss
+            except psutil.Error:
+                peak = None
+        elif self.rss_method is not None:
+            peak = self.take_peak_rss()
+        else:
+            peak = None
+        if peak is not None:
+            for token, active_peak in self.active_peaks.items():
+                self.active_peaks[token] = max(active_peak or 0, peak)
+
+    @contextmanager
+    def stage(self, name, items=1, cuda=False):
+        if not self.enabled:
+            yield
+            return
+        token = object()
+        with self.lock:
+            self._fold_peak_rss()
+            self.active_peaks[token] = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if cuda and torch.cuda.is_available():
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            cuda_peak = None
+            with self.lock:
+                self._fold_peak_rss()
+                rss = self.active_peaks.pop(token)
+                if cuda and torch.cuda.is_available():
+                    # 同時有多個 GPU stage 時高點歸給先結束的那個，僅供參考
+                    cuda_peak = torch.cuda.max_memory_allocated()
+                    torch.cuda.reset_peak_memory_stats()
+                stat = self.stats.setdefault(name, {'calls': 0, 'items': 0, 'seconds': 0.0, 'first_start': start, 'last_end': end, 'peak_rss': None, 'peak_cuda': None})
+                stat['calls'] += 1
+                stat['items'] += items
+                stat['seconds'] += end - start
+                stat['first_start'] = min(stat['first_start'], start)
+                stat['last_end'] = max(stat['last_end'], end)
+                if rss is not None:
+                    stat['peak_rss'] = max(stat['peak_rss'] or 0, rss)
+                if cuda_peak is not None:
+                    stat['peak_cuda'] = max(stat['peak_cuda'] or 0, cuda_peak)
+                self.events.append({
+                    'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                    'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6, 'args': {'items': items},
+                })
+
+    def summary(self):
+        """
+        每個 stage 的 seconds 為各次呼叫時間總和，wall_seconds 為第一次開始到最後一次結束，items_per_second 以 seconds 計算。
+        """
+        stages = {}
+        with self.lock:
+            for name, stat in self.stats.items():
+                stages[name] = {
+                    'calls': stat['calls'],
+                    'items': stat['items'],
+                    'seconds': round(stat['seconds'], 6),
+                    'wall_seconds': round(stat['last_end'] - stat['first_start'], 6),
+                    'items_per_second': round(stat['items'] / stat['seconds'], 3) if stat['seconds'] > 0 else None,
+                    'peak_rss_mb': round(stat['peak_rss'] / 2**20, 1) if stat['peak_rss'] is not None else 'unavailable',
+                    'peak_cuda_mb': round(stat['peak_cuda'] / 2**20, 1) if stat['peak_cuda'] is not None else None,
+                }
+        peak_rss = {'method': self.rss_method, 'note': self.rss_notes[self.rss_method]}
+        return {'total_seconds': round(time.perf_counter() - self.origin, 6), 'peak_rss': peak_rss, 'stages': stages}
+
+    def write(self, summary_path=None, trace_path=None):
+        if summary_path:
+            summary = self.summary()
+            with open(summary_path, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+            for name, stat in summary['stages'].items():
+                peak_rss = f"{stat['peak_rss_mb']} MB" if stat['peak_rss_mb'] != 'unavailable' else 'unavailable'
+                print(f"{name}: {stat['items']} items, {stat['seconds']:.2f}s, {stat['items_per_second']} items/s, peak RSS {peak_rss}")
+            print(f"peak RSS: {summary['peak_rss']['note']}")
+        if trace_path:
+            with self.lock:
+                events = list(self.events)
+            with open(trace_path, 'w', encoding='utf-8') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+profiler = StageProfiler()
+
+def get_florence():
+    """
+    首次使用時才載入 Florence-2，返回 (model, processor)。
+    """
+    with model_lock:
+        if 'florence' not in models:
+            with profiler.stage('load_models'):
+                model = AutoModelForCausalLM.from_pretrained(model_id, trust_remote_code=True).eval().to(device).half()
+                processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+            models['florence'] = (model, processor)
+    return models['florence']
+
+def get_clip():
+    """
+    首次使用時才載入 LongCLIP，返回 (clip_model, clip_preprocess)。
+    """
+    with model_lock:
+        if 'clip' not in models:
+            with profiler.stage('load_models'):
+                models['clip'] = longclip.load(clip_checkpoint, device=device)
+    return models['clip']
+
+def get_aesthetic():
+    """
+    首次使用時才載入美學模型，返回 (aes_model, aes_preprocessor)。
+    """
+    with model_lock:
+        if 'aesthetic' not in models:
+            with profiler.stage('load_models'):
+                aes_model, aes_preprocessor = convert_v2_5_from_siglip(
+                    low_cpu_mem_usage=True,
+                    trust_remote_code=True,
+                )
+                models['aesthetic'] = (aes_model.to(torch.bfloat16).to(device), aes_preprocessor)
+    return models['aesthetic']
 
 chartags = {
     'long hair', 'short hair', 'blue eyes', 'large breasts', 'blonde hair', 'brown hair', 'black hair', 'hair ornament', 'red eyes', 'hat', 'bow', 'animal ears', 'ribbon', 'hair between eyes', 'very long hair', 'twintails', 'medium breasts', 'brown eyes', 'green eyes', 'blue hair', 'purple eyes', 'tail', 'yellow eyes', 'white hair', 'pink hair', 'grey hair', 'ahoge', 'braid', 'hair ribbon', 'purple hair', 'ponytail', 'multicolored hair', 'sidelocks', 'hair bow', 'earrings', 'red hair', 'small breasts', 'hairband', 'horns', 'wings', 'green hair', 'glasses', 'pointy ears', 'hairclip', 'medium hair', 'fang', 'dark skin', 'cat ears', 'blunt bangs', 'hair flower', 'pink eyes', 'hair bun', 'mole', 'hair over one eye', 'rabbit ears', 'orange hair', 'black eyes', 'two-tone hair', 'streaked hair', 'huge breasts', 'halo', 'red bow', 'twin braids', 'side ponytail', 'animal ear fluff', 'red ribbon', 'aqua eyes', 'dark-skinned female', 'parted bangs', 'two side up', 'v-shaped eyebrows', 'grey eyes', 'orange eyes', 'cat tail', 'symbol-shaped pupils', 'eyelashes', 'lips', 'black headwear', 'mole under eye', 'fox ears', 'maid headdress', 'shiny skin', 'fake animal ears', 'black bow', 'single braid', 'neck ribbon', 'black ribbon', 'gradient hair', 'double bun', 'floating hair', 'aqua hair', 'colored skin', 'swept bangs', 'facial hair', 'heterochromia', 'white headwear', 'blue bow', 'fox tail', 'witch hat', 'low twintails', 'one side up', 'headband', 'horse ears', 'beret', 'wavy hair', 'fangs', 'headphones', 'hair intakes', 'facial mark', 'thick eyebrows', 'horse girl', 'headgear', 'muscular male', 'heart-shaped pupils', 'bob cut', 'drill hair', 'sunglasses', 'dark-skinned male', 'light brown hair', 'wolf ears', 'black hairband', 'eyepatch', 'scrunchie', 'white bow', 'demon girl', 'cat girl', 'mob cap', 'magical girl', 'eyes visible through hair', 'demon horns', 'single hair bun', 'high ponytail', 'x hair ornament', 'fox girl', 'blue ribbon', 'grabbing another\'s breast', 'antenna hair', 'hat ribbon', 'crown', 'pink bow', 'spiked hair', 'bat wings', 'ear piercing', 'slit pupils', 'bright pupils', 'monster girl', 'rabbit tail', 'tassel', 'head wings', 'short twintails', 'messy hair', 'horse tail', 'straight hair', 'feathered wings', 'hat bow', 'multiple tails', 'extra ears', 'eyewear on head', 'demon tail', 'dog ears', 'pale skin', 'red headwear', 'white ribbon', 'between breasts', 'colored inner hair', 'hair over shoulder', 'skin fang', 'mole under mouth', 'side braid', 'third eye', 'scar on face', 'baseball cap', 'beard', 'blue headwear', 'peaked cap', 'glowing eyes', 'white pupils', 'semi-rimless eyewear', 'low ponytail', 'twin drills', 'yellow bow', 'wolf tail', 'eyeshadow', 'french braid', 'no headwear', 'tokin hat', 'crossed bangs', 'black wings', 'green bow', 'single horn', 'dragon horns', 'drinking glass', 'hair scrunchie', 'santa hat', 'pink ribbon', 'half updo', 'freckles', 'demon wings', 'topless male', 'single earring', 'low-tied long hair', 'white skin', 'hair rings', 'mature male', 'unworn headwear', 'mole on breast', 'black-framed eyewear', 'short ponytail', 'purple bow', 'round eyewear', 'angel wings', 'goggles on head', 'braided ponytail', 'red-framed eyewear', 'curly hair', 'raised eyebrows', 'hat ornament', 'dragon girl', 'faceless male', 'asymmetrical hair', 'dog tail', 'yellow ribbon', 'top hat', 'sun hat', 'furry female', 'white hairband', 'asymmetrical bangs', 'fake tail', 'blood on face', 'star hair ornament', 'under-rim eyewear', 'white wings', 'mature female', 'multicolored eyes', 'colored eyelashes', 'rabbit girl', 'hoop earrings', 'bouncing breasts', 'unworn hat', 'tentacle hair', 'eyebrows hidden by hair', 'green headwear', 'wolf girl', 'light blue hair', 'mini hat', 'military hat', 'brown headwear', 'dragon tail', 'striped bow', 'tress ribbon', 'pink lips', 'short eyebrows', 'scar across eye', 'mustache', 'folded ponytail', 'dog girl', 'furry male', 'blue skin', 'heart hair ornament', 'muscular female', 'red hairband', 'hime cut', 'mouse ears', 'bandaid on face', 'nurse cap', 'purple ribbon', 'butterfly hair ornament', 'straw hat', 'green ribbon', 'visor cap', 'orange bow', 'stud earrings', 'licking lips', 'bags under eyes', 'low wings', 'long bangs', 'eyeliner', 'red lips', 'fake horns', 'back bow', 'crown braid', 'tail ornament', 'hanging breasts', 'sailor hat', 'hair behind ear', 'cabbie hat', 'flipped hair', 'single side bun', 'absurdly long hair', 'frog hair ornament', 'on head', 'fairy wings', 'star-shaped pupils', 'bird wings', 'hair over eyes', 'cow ears', 'glass', 'food-themed hair ornament', 'pink headwear', 'wrist scrunchie', 'black horns', 'headdress', 'feather hair ornament', 'tinted eyewear', 'ringed eyes', 'mask on head', 'covered eyes', 'horn ornament', 'cow horns', 'mini crown', 'very short hair', 'blue hairband', 'green skin', 'blue halo', 'tiger ears', 'symbol in eye', 'wet hair', 'purple headwear', 'flat cap', 'wine glass', 'snake hair ornament', 'cone hair bun', 'curled horns', 'ice wings', 'bald', 'mechanical halo', 'red horns', 'animal hat', 'raccoon ears', 'pink halo', 'unworn eyewear', 'lolita hairband', 'star earrings', 'crescent hair ornament', 'mouse tail', 'leg ribbon', 'garrison cap', 'white eyes', 'deep skin', 'frilled bow', 'tilted headwear', 'animal on head', 'grey skin', 'ear ornament', 'asymmetrical wings', 'two tails', 'facial tattoo', 'crescent hat ornament', 'rolling eyes', 'toned male', 'no pupils', 'glowing eye', 'fish tail', 'constricted pupils', 'split-color hair', 'leaf hair ornament', 'rabbit hair ornament', 'red skin', 'chest hair', 'leaf on head', 'goat horns', 'necktie between breasts', 'raccoon tail', 'multicolored skin', 'polka dot bow', 'ears through headwear', 'purple skin', 'heart earrings', 'double-parted bangs', 'dark blue hair', 'big hair', 'frilled hairband', 'hair over breasts', 'blank eyes', 'lion ears', 'sparkling eyes', 'tiger tail', 'cow girl', 'huge ahoge', 'tassel earrings', 'star hat ornament', 'braided bun', 'assertive female', 'grey headwear', 'mini top hat', 'arm ribbon', 'braided bangs', 'bear ears', 'shark tail', 'red halo', 'red eyeshadow', 'sheep horns', 'insect wings', 'rimless eyewear', 'bow hairband', 'skin-covered horns', 'yellow halo', 'anchor hair ornament', 'navel hair', 'yellow hairband', 'no eyes', 'ear bow', 'gigantic breasts', 'extra eyes', 'long braid', 'jphones', 'large bow', 'tail ribbon', 'bird ears', 'pink skin', 'cat boy', 'shark girl', 'mouse girl', 'arthropod girl', 'fur hat', 'fur-trimmed headwear', 'raised eyebrow', 'black skin', 'frilled hat', 'striped ribbon', 'waist bow', 'super crown', 'low twin braids', 'crazy eyes', 'cat hair ornament', 'blue wings', 'naked ribbon', 'butterfly wings', 'multiple hair bows', 'demon boy', 'sagging breasts', 'dress bow', 'red scrunchie', 'dragon wings', 'forked eyebrows', 'armpit hair', 'footwear bow', 'purple hairband', 'multiple wings', 'wrist ribbon', 'v over eye', 'red pupils', 'pirate hat', 'towel on head', 'orange headwear', 'bow-shaped hair', 'against glass', 'leg hair', 'mini wings', 'multiple horns', 'carrot hair ornament', 'long eyelashes', 'backwards hat', 'black tail', 'red headband', 'tiger girl', 'mechanical wings', 'white horns', 'musical note hair ornament', 'unaligned breasts', 'orange ribbon', 'heart-shaped eyewear', 'small horns', 'uneven eyes', 'lion tail', 'dangle earrings', 'print bow', 'dog boy', 'raccoon girl', 'blue scrunchie', 'lion girl', 'opaque glasses', 'robot ears', 'christmas ornaments', 'biting own lip', 'framed breasts', 'wizard hat', 'cat ear headphones', 'quad tails', 'bandage over one eye', 'sheep ears', 'arms under breasts', 'diagonal bangs', 'wing hair ornament', 'perky breasts', 'bone hair ornament', 'striped tail', 'cuts', 'medical eyepatch', 'braided hair rings', 'multicolored wings', 'rectangular eyewear', 'purple wings', 'squirrel ears', 'ear ribbon', 'black headband', 'multiple earrings', 'single hair intake', 'sheep girl', 'updo', 'bat hair ornament', 'goggles on headwear', 'horned headwear', 'white scrunchie', 'red eyeliner', 'black scrunchie', 'white headband', 'blue-framed eyewear', 'squirrel tail', 'horn bow', 'green hairband', 'horizontal pupils', 'stained glass', 'wolf boy', 'horseshoe ornament', 'chef hat', 'black lips', 'fox boy', 'multi-tied hair', 'slime girl', 'animal ear piercing', 'shark hair ornament', 'bird girl', 'gold earrings', 'tassel hair ornament', 'feather hair', 'puckered lips', 'orange hairband', 'ankle ribbon', 'flower earrings', 'grey horns', 'crescent earrings', 'yellow pupils', 'drill sidelocks', 'pink scrunchie', 'strap between breasts', 'winged hat', 'ghost tail', 'porkpie hat', 'parted hair', 'squirrel girl', 'police hat', 'over-rim eyewear', 'diagonal-striped bow', 'shower head', 'monkey tail', 'energy wings', 'wide ponytail', 'snowflake hair ornament', 'yellow scrunchie', 'brown ribbon', 'jackal ears', 'bandaged head', 'high side ponytail', 'blue lips', 'clover hair ornament', 'diamond-shaped pupils', 'long pointy ears', 'frilled ribbon', 'broken glass', 'flame-tipped tail', 'turning head', 'tiger boy', 'hair horns', 'skin fangs', 'deer ears', 'looking over eyewear', 'pink-framed eyewear', 'feather earrings', 'broken horn', 'laurel crown', 'large hat', 'flaming eye', 'pom pom hair ornament', 'grey bow', 'disembodied head', 'narrowed eyes', 'no eyewear', 'yellow skin', 'orange scrunchie', 'aqua ribbon', 'large tail', 'averting eyes', 'dreadlocks', 'character hair ornament', 'mechanical horns', 'grey-framed eyewear', 'star halo', 'cocktail glass', 'striped horns', 'multiple moles', 'curtained hair', 'cat hat', 'green lips', 'shako cap', 'buzz cut', 'dragon boy', 'alternate headwear', 'asymmetrical horns', 'short bangs', 'orange-tinted eyewear', 'cracked skin', 'yellow-framed eyewear', 'bandage on face', 'snake tail', 'thigh ribbon', 'afro', 'white-framed eyewear', 'd-pad hair ornament', 'tri tails', 'spread wings', 'school hat', 'tall female', 'bisexual female', 'cone horns', 'pink pupils', 'hair through headwear', 'mechanical tail', 'prehensile hair', 'patchwork skin', 'blue eyeshadow', 'drop earrings', 'veiny breasts', 'two-tone ribbon', 'bear hair ornament', 'bowl hat', 'gold hairband', 'spider girl', 'red-tinted eyewear', 'eyebrow cut', 'animal ear headwear', 'goat ears', 'single hair ring', 'fish hair ornament', 'dixie cup hat', 'leopard ears', 'skull earrings', 'party hat', 'blue horns', 'brushing hair', 'plaid headwear', 'white tail', 'brown hairband', 'blood from eyes', 'fiery hair', 'green halo', 'dyed bangs', 'two-tone eyes', 'wrinkled skin', 'bat ears', 'black halo', 'upturned eyes', 'bowl cut', 'bear girl', 'blue headband', 'yellow wings', 'fish girl', 'fake wings', 'x-shaped pupils', 'fake facial hair', 'flower ornament', 'pillbox hat', 'circle cut', 'yellow horns', 'body hair', 'hair ears', 'bow earrings', 'no wings', 'doughnut hair bun', 'green-framed eyewear', 'magnifying glass', 'eyewear on headwear', 'brown horns', 'plant girl', 'pink eyeshadow', 'multiple braids', 'magatama earrings', 'brown-framed eyewear', 'blue-tinted eyewear', 'cow boy', 'spiked tail', 'purple eyeshadow', 'body freckles', 'multicolored bow', 'heart tail', 'large wings', 'triangle earrings', 'rabbit boy', 'horns through headwear', 'purple-tinted eyewear', 'unusually open eyes', 'sunflower hair ornament', 'lizard tail', 'multicolored horns', 'arm between breasts', 'two-tone headwear', 'panda ears', 'fake mustache', 'expressive hair', 'purple tail', 'drawing bow', 'object through head', 'pink wings', 'blue pupils', 'transparent wings', 'purple horns', 'phoenix crown', 'artificial eye', 'grey ribbon', 'striped headwear', 'goat girl', 'tulip hat', 'crystal hair', 'aqua headwear', 'arched bangs', 'broken halo', 'mechanical ears', 'brown wings', 'leopard tail', 'grey halo', 'no eyebrows', 'notched ear', 'monkey ears', 'pink-tinted eyewear', 'fiery horns', 'uneven horns', 'jaguar ears', 'purple halo', 'sphere earrings', 'bat girl', 'candy hair ornament', 'tapir tail', 'dark halo', 'ruffling hair', 'diving mask on head', 'triangle hair ornament', 'mechanical eye', 'huge bow', 'robot girl', 'sleeve bow', 'rabbit-shaped pupils', 'dice hair ornament', 'button eyes',  'prehensile tail', 'multicolored headwear', 'green wings', 'solid eyes', 'thick lips', 'compass rose halo', 'brown tail', 'strawberry hair ornament', 'food-themed earrings', 'split ponytail', 'two-tone bow', 'neck tassel', 'lion boy', 'two-tone hairband', 'gradient skin', 'polka dot headwear', 'purple scrunchie', 'glowing wings', 'crystal earrings', 'liquid hair', 'orange skin', 'cetacean tail', 'glowing hair', 'smokestack hair ornament', 'panties on head', 'crocodilian tail', 'long tail', 'pearl earrings', 'glowing horns', 'red tail', 'print headwear', 'egg hair ornament', 'side drill', 'blue tail', 'huge eyebrows', 'hair wings', 'snake hair', 'thick eyelashes', 'swim cap', 'grey tail', 'choppy bangs', 'aviator sunglasses', 'pill earrings', 'no tail', 'pink tail', 'owl ears', 'pointy breasts', 'hat over one eye', 'full beard', 'bandaid hair ornament', 'footwear ribbon', 'grey hairband', 'coin hair ornament', 'bucket hat', 'alpaca ears', 'yellow tail', 'low-tied sidelocks', 'weasel ears', 'wrist bow', 'grey wings', 'pursed lips', 'no eyepatch', 'deer girl', 'white headdress', 'green tail', 'wing ornament', 'mismatched eyebrows', 'sleeve ribbon', 'purple-framed eyewear', 'rainbow hair', 'hedgehog ears', 'sideways hat', 'flower on head', 'coke-bottle glasses', 'fish boy', 'orange tail', 'hard hat', 'hair on horn', 'ribbon-trimmed headwear', 'multiple heads', 'flower over eye', 'yellow-tinted eyewear', 'otter ears', 'dashed eyes', 'low-braided long hair', 'arm above head', 'lace-trimmed hairband', 'four-leaf clover hair ornament', 'potara earrings', 'detached hair', 'cephalopod eyes', 'long beard', 'camouflage headwear', 'japari bun', 'star ornament', 'striped hairband', 'hat with ears', 'bunching hair', 'ears visible through hair', 'green scrunchie', 'thick mustache', 'diamond hairband', 'polka dot scrunchie', 'cherry hair ornament', 'bear tail', 'jaguar tail', 'v-shaped eyes', 'rabbit hat', 'thick beard', 'hugging tail', 'no mole', 'green-tinted eyewear', 'ornament', 'diamond hair ornament', 'wavy eyes', 'shell hair ornament', 'heart-shaped eyes', 'chain headband', 'planet hair ornament', 'pearl hair ornament', 'multicolored hairband', 'drop-shaped pupils', 'polka dot ribbon', 'ribbon braid', 'alternate wings', 'hollow eyes', 'unworn eyepatch',  'spaceship hair ornament', 'bowler hat', 'green eyeshadow', 'pumpkin hair ornament', 'spiked hairband', 'flower in eye', 'magical boy', 'behind-the-head headphones', 'plaid ribbon', 'skull ornament', 'bear boy', 'holly hair ornament', 'uneven twintails', 'folded hair', 'pig ears', 'metal skin', 'pumpkin hat', 'cut bangs', 'mole under each eye', 'clock eyes', 'reptile girl', 'hair between breasts', 'alternate hair ornament', 'licking ear', 'braiding hair', 'hexagon hair ornament', 'tri braids', 'animal ear hairband', 'solid circle pupils', 'penis to breast', 'frog girl', 'curly eyebrows', 'star-shaped eyewear', 'fiery wings', 'orange headband', 'scratching head', 'bloodshot eyes', 'green horns', 'green headband', 'single head wing', 'animal head', 'bulging eyes', 'deer tail', 'weasel girl', 'brown lips', 'lifebuoy ornament', 'frilled headwear', 'cable tail', 'safety glasses', 'leopard girl', 'wing ears', 'spade hair ornament', 'white halo', 'weasel tail', 'propeller hair ornament', 'wide oval eyes', 'otter tail', 'pom pom earrings', 'checkered bow', 'fruit hat ornament', 'starfish hair ornament', 'aqua hairband', 'crystal wings', 'object head', 'multicolored tail', 'gradient wings', 'giant male', 'purple pupils', 'torn wings', 'head on head', 'moose ears', 'pointy hat', 'hair over one breast', 'forked tail', 'lightning bolt hair ornament', 'undone neck ribbon', 'hedgehog tail', 'lop rabbit ears', 'sparse chest hair', 'pink horns', 'pokemon ears', 'ankle bow', 'bird boy', 'bandaid on head', 'implied extra ears', 'hat tassel', 'fruit on head', 'starry hair', 'sparkle hair ornament', 'long ribbon', 'rice hat', 'washing hair', 'anchor earrings', 'asymmetrical sidelocks', 'mini witch hat', 'unworn hair ornament', 'heart hair', 'arthropod boy', 'detached ahoge', 'large ears', 'aviator cap', 'monkey boy', 'female service cap', 'moth girl', 'glove bow', 'bangs', 'shiny hair', 'light purple hair', 'oni horns', 'pillow hat', 'polos crown', 'light green hair', 'monocle hair ornament', 'dark green hair', 'pouty lips', 'bunny-shaped pupils', 'bunny hatester cap', 'detached wings', 'solid oval eyes', 'cube hair ornament', 'heart ahoge', 'cross-shaped pupils', 'cross hair ornament', 'pointy hair', 'very dark skin', 'aqua bow', 'front ponytail', 'pink hairband', 'skull hair ornament', 'side braids', 'tail bow', 'cross earrings', 'horn ribbon', 'cow tail', 'floppy ears', 'two-tone skin', 'plaid bow', 'purple lips', 'single sidelock', 'solid circle eyes', 'yellow headwear', 'faceless female', 'single wing', 'brown bow', 'medium bangs', 'red wings', 'monster boy', 'mismatched pupils', 'cowboy hat', 'flower-shaped pupils', 'bird tail', 'gradient eyes', 'bursting breasts', 'animal ear head', 'hair bobbles', 'prosthetic leg', 'centaur'
@@ -60,43 +288,389 @@ people_tags = [
     r'^1girl$', r'^1boy$', r'^69$', r'^absolutely_everyone$', r'^after_kiss$', r'^age_comparison$', r'^age_difference$', r'^age_progression$', r'^angel_and_devil$', r'^anilingus$', r'^ankle_grab$', r'^anti-aircraft$', r'^armpit_sex$', r'^arms_around_neck$', r'^arms_around_waist$', r'^arm_around_back$', r'^arm_around_neck$', r'^arm_around_shoulder$', r'^arm_around_waist$', r'^arm_held_back$', r'^arm_hug$', r'^ass-to-ass$', r'^asymmetrical_docking$', r'^back-to-back$', r'^band$', r'^behind_another$', r'^black_vs_white$', r'^bound_together$', r'^boy_on_top$', r'^boy_sandwich$', r'^breastfeeding$', r'^breasts_on_head$', r'^breast_envy$', r'^grabbing_another\'s_breast$', r'^breast_smother$', r'^breast_sucking$', r'^buttjob$', r'^caressing_testicles$', r'^carrying_person$', r'^chart$', r'^chasing$', r'^cheating_\(relationship\)$', r'^cheek-to-cheek$', r'^chikan$', r'^child_carry$', r'^child_on_child$', r'^circle_formation$', r'^clog_sandals$', r'^clone$', r'^clothed_female_nude_female$', r'^clothed_female_nude_male$', r'^clothed_male_nude_female$', r'^clothed_sex$', r'^coffee_cup$', r'^collage$', r'^colored_text$', r'^column_lineup$', r'^comforting$', r'^cooperative_fellatio$', r'^cooperative_paizuri$', r'^copyright$', r'^costume_switch$', r'^couple$', r'^cousins$', r'^covering_another\'s_eyes$', r'^covering_another\'s_mouth$', r'^covering_mouth$', r'^cowgirl_position$', r'^cross-section$', r'^cuddling$', r'^cum_in_nose$', r'^cum_overflow$', r'^cunnilingus$', r'^cute_$', r'^dark_penis$', r'^deepthroat$', r'^deep_penetration$', r'^disembodied_limb$', r'^disembodied_penis$', r'^doggystyle$', r'^double_handjob$', r'^dressing_another$', r'^dual_persona$', r'^duckling$', r'^duel$', r'^ear_biting$', r'^ejaculating_while_penetrated$', r'^ejaculation$', r'^emotionless_sex$', r'^everyone$', r'^evolutionary_line$', r'^expression_chart$', r'^eye_contact$', r'^face-to-face$', r'^facepalm$', r'^face_to_breasts$', r'^facing_another$', r'^fellatio$', r'^female_child$', r'^femdom$', r'^fff_threesome$', r'^ffm_threesome$', r'^fighting$', r'^finger_biting$', r'^finger_in_another\'s_mouth$', r'^finger_to_another\'s_mouth$', r'^flashback$', r'^flat_chest_grab$', r'^fleeing$', r'^footjob$', r'^foot_worship$', r'^forehead-to-forehead$', r'^french_kiss$', r'^friends$', r'^frilled_swimsuit$', r'^frottage$', r'^full_nelson$', r'^fume$', r'^furry_with_furry$', r'^furry_with_non-furry$', r'^futa_on_male$', r'^futa_with_female$', r'^futa_with_futa$', r'^futa_with_male$', r'^gangbang$', r'^girl_on_top$', r'^girl_sandwich$', r'^glansjob$', r'^glomp$', r'^gloved_handjob$', r'^grabbing$', r'^grabbing_another\'s_ass$', r'^grabbing_another\'s_breast$', r'^grabbing_another\'s_chin$', r'^grabbing_another\'s_hair$', r'^grabbing_from_behind$', r'^greek_clothes$', r'^griffin_$', r'^grinding$', r'^groom$', r'^groping$', r'^group_hug$', r'^group_picture$', r'^group_sex$', r'^guided_breast_grab$', r'^guided_penetration$', r'^guiding_hand$', r'^hairjob$', r'^handjob$', r'^handshake$', r'^hands_on_another\'s_cheeks$', r'^hands_on_another\'s_chest$', r'^hands_on_another\'s_face$', r'^hands_on_another\'s_head$', r'^hands_on_another\'s_hips$', r'^hands_on_another\'s_shoulders$', r'^hands_on_another\'s_thighs$', r'^hands_on_shoulders$', r'^hand_grab$', r'^hand_in_another\'s_hair$', r'^hand_on_another\'s_arm$', r'^hand_on_another\'s_ass$', r'^hand_on_another\'s_back$', r'^hand_on_another\'s_cheek$', r'^hand_on_another\'s_chest$', r'^hand_on_another\'s_chin$', r'^hand_on_another\'s_ear$', r'^hand_on_another\'s_face$', r'^hand_on_another\'s_hand$', r'^hand_on_another\'s_head$', r'^hand_on_another\'s_hip$', r'^hand_on_another\'s_leg$', r'^hand_on_another\'s_neck$', r'^hand_on_another\'s_shoulder$', r'^hand_on_another\'s_stomach$', r'^hand_on_another\'s_thigh$', r'^hand_on_another\'s_waist$', r'^happy_sex$', r'^harem$', r'^headpat$', r'^heads_together$', r'^head_between_breasts$', r'^head_grab$', r'^head_on_another\'s_shoulder$', r'^head_on_chest$', r'^heart_hands_duo$', r'^heckler_$', r'^height_difference$', r'^hetero$', r'^holding_another\'s_arm$', r'^holding_another\'s_foot$', r'^holding_another\'s_hair$', r'^holding_another\'s_leg$', r'^holding_another\'s_wrist$', r'^holding_hair$', r'^holding_hands$', r'^holding_pokemon$', r'^holomyth$', r'^hoop_piercing$', r'^horn_grab$', r'^hug$', r'^hug_from_behind$', r'^humping$', r'^imminent_fellatio$', r'^imminent_kiss$', r'^imminent_penetration$', r'^imminent_vaginal$', r'^implied_fingering$', r'^implied_futanari$', r'^implied_kiss$', r'^in-franchise_crossover$', r'^incest$', r'^infinity$', r'^instant_loss$', r'^internal_cumshot$', r'^interracial$', r'^interspecies$', r'^invisible_man$', r'^in_the_face$', r'^irrumatio$', r'^jealous$', r'^josou_seme$', r'^just_the_tip$', r'^kabedon$', r'^kanshou_$', r'^kiss$', r'^kissing_cheek$', r'^kissing_forehead$', r'^kissing_hand$', r'^kissing_neck$', r'^kissing_penis$', r'^lap_pillow$', r'^leaning_on_person$', r'^left-to-right_manga$', r'^legwear_under_shorts$', r'^leg_between_thighs$', r'^leg_grab$', r'^leg_lock$', r'^licking_another\'s_face$', r'^licking_armpit$', r'^licking_foot$', r'^licking_nipple$', r'^licking_penis$', r'^lifted_by_another$', r'^lifting_another\'s_clothes$', r'^lifting_person$', r'^light_blue_background$', r'^lineup$', r'^locked_arms$', r'^lolidom$', r'^looking_at_another$', r'^looking_at_penis$', r'^lying_on_lap$', r'^lying_on_person$', r'^massage$', r'^matching_outfits$', r'^matching_outfits$', r'^mating_press$', r'^missionary$', r'^misunderstanding$', r'^mixed-sex_bathing$', r'^mixed_bathing$', r'^mmf_threesome$', r'^mmm_threesome$', r'^mod3_\(girls\'_frontline\)$', r'^molestation$', r'^motherly$', r'^mouse$', r'^mtu_virus$', r'^multiple_4koma$', r'^multiple_boys$', r'^multiple_crossover$', r'^multiple_drawing_challenge$', r'^multiple_girls$', r'^multiple_others$', r'^multiple_penises$', r'^multiple_persona$', r'^multiple_riders$', r'^multiple_views$', r'^multitasking$', r'^mutual_hug$', r'^mutual_masturbation$', r'^netorare$', r'^nipple-to-nipple$', r'^noses_touching$', r'^nursing_handjob$', r'^odd_one_out$', r'^onee-loli$', r'^onee-shota$', r'^onii-shota$', r'^on_person$', r'^oral$', r'^orgy$', r'^out_of_frame$', r'^overflow$', r'^paizuri$', r'^paizuri_under_clothes$', r'^penises_touching$', r'^penis_awe$', r'^penis_grab$', r'^penis_on_ass$', r'^penis_on_face$', r'^penis_size_difference$', r'^people$', r'^perpendicular_paizuri$', r'^person_on_head$', r'^phone_screen$', r'^picture_\(object\)$', r'^piggyback$', r'^pikmin_\(creature\)$', r'^pointing_at_another$', r'^pokemon_on_head$', r'^pokemon_on_shoulder$', r'^pokephilia$', r'^pov_crotch$', r'^pov_hands$', r'^prank$', r'^princess_carry$', r'^print_legwear$', r'^prone_bone$', r'^protecting$', r'^pulled_by_another$', r'^pulling_another\'s_clothes$', r'^pushing$', r'^pushing_away$', r'^reach-around$', r'^remembering$', r'^reverse_cowgirl_position$', r'^reverse_suspended_congress$', r'^reverse_upright_straddle$', r'^rhodes_island_logo$', r'^riding_pokemon$', r'^rotational_symmetry$', r'^rough_sex$', r'^sailor_senshi$', r'^same-sex_bathing$', r'^sandwiched$', r'^see-through_swimsuit$', r'^selfcest$', r'^sequential$', r'^sex$', r'^sextuplets$', r'^sexual_coaching$', r'^sex_from_behind$', r'^shared_bathing$', r'^shared_clothes$', r'^shared_earphones$', r'^shared_food$', r'^shared_object_insertion$', r'^shared_scarf$', r'^shared_speech_bubble$', r'^shared_umbrella$', r'^shimaidon_\(sex\)$', r'^shiny_and_normal$', r'^shoulder_carry$', r'^siblings$', r'^side-by-side$', r'^sisters$', r'^sitting_on_bench$', r'^sitting_on_face$', r'^sitting_on_lap$', r'^sitting_on_person$', r'^sitting_on_shoulder$', r'^size_difference$', r'^slapping$', r'^sleeping_on_person$', r'^sleeve_grab$', r'^sling$', r'^solo_focus$', r'^spitroast$', r'^spitting$', r'^spit_take$', r'^spooning$', r'^square_4koma$', r'^squatting_cowgirl_position$', r'^standing_sex$', r'^starter_pokemon_trio$', r'^stealth_sex$', r'^still_life$', r'^straddling$', r'^straddling_paizuri$', r'^strangling$', r'^strap-on$', r'^surprise_kiss$', r'^surrounded_by_penises$', r'^suspended_congress$', r'^symmetrical_docking$', r'^tail_around_leg$', r'^tail_feathers$', r'^take_your_pick$', r'^teacher_and_student$', r'^teamwork$', r'^team_9$', r'^testicle_grab$', r'^testicle_sucking$', r'^thigh_grab$', r'^thigh_sex$', r'^threesome$', r'^time_paradox$', r'^torso_grab$', r'^tribadism$', r'^triplets$', r'^turnaround$', r'^twincest$', r'^twins$', r'^two-footed_footjob$', r'^two-handed_handjob$', r'^ugly_man$', r'^undressing_another$', r'^upright_straddle$', r'^uterus$', r'^vaginal$', r'^variations$', r'^walk-in$', r'^window_shade$', r'^wrestling$', r'^yaoi$', r'^yuri$', r'^:>=$'
     ] 
 
+patterns_to_keep = [
+    r'^anime.*$', r'^monochrome$', r'^.*background$', r'^comic$', r'^greyscale$', r'^sketch$', 
+    r'^.*censor.*$', r'^.*_name$', r'^signature$', r'^.*_username$', r'^.*text.*$', 
+    r'^.*_bubble$', r'^multiple_views$', r'^.*blurry.*$', r'^.*koma$', r'^watermark$', 
+    r'^traditional_media$', r'^parody$', r'^.*cover$', r'^.*_theme$', r'^.*realistic$', 
+    r'^oekaki$', r'^3d$', r'^.*chart$', r'^letterboxed$', r'^variations$', r'^.*mosaic.*$', 
+    r'^omake$', r'^column.*$', r'^.*_(medium)$', r'^manga$', r'^lineart$', r'^.*logo$'            
+    #r'^(from_side|from_behind|from_above|from_below)$', r'^(close_up|dutch_angle|downblouse|downpants|pantyshot|upskirt|atmospheric_perspective|fisheye|panorama|perspective|pov|rotated|sideways|upside_down|vanishing_point|straight-on)$', r'^(face|cowboy_shot|portrait|upper_body|lower_body|feet_out_of_frame|full_body|wide_shot|very_wide_shot|cut_in|cropped_legs|head_out_of_frame|cropped_torso|cropped_arms|cropped_shoulders|profile|group_profile)$', r'^(armpit_focus|ass_focus|back_focus|breast_focus|eye_focus|foot_focus|hand_focus|hip_focus|navel_focus|pectoral_focus|thigh_focus|soft_focus|solo_focus)$'
+]
+keep_tag_rules = TagRules(patterns_to_keep)
+solo_keep_tag_rules = keep_tag_rules.extend([r'^holding_.*$'])
+#, r'^.*grab.*$', r'^.*lift.*$', r'^.*pull$', r'^.*_own_.*$', r'^.*covered.*$', r'^.*_masturbation.*$', r'^.*out.*$', r'^.*_between_.*$'
+
 view_labels = [
     "portrait", "upper body", "lower body", "cowboy shot", "feet out of frame",
     "full body", "wide shot", "very wide shot", "close-up", "cut-in", "split crop",
     "profile", "from behind", "from side", "upside-down"
 ]
 
-text_features_dict = {}
+def checkpoint_fingerprint(checkpoint_path, chunk_size=1 << 20):
+    """
+    以檔案大小和頭尾各 1MB 內容計算權重指紋，避免每次啟動都對整個權重檔做雜湊。
+    """
+    sha = hashlib.sha256()
+    file_size = os.path.getsize(checkpoint_path)
+    sha.update(str(file_size).encode())
+    with open(checkpoint_path, 'rb') as f:
+        sha.update(f.read(chunk_size))
+        if file_size > chunk_size:
+            f.seek(max(chunk_size, file_size - chunk_size))
+            sha.update(f.read(chunk_size))
+    return sha.hexdigest()[:16]
+
+@contextmanager
+def file_lock(lock_path, stale_after=120.0):
+    """
+    以 O_EXCL 建立鎖檔做跨行程互斥 (Windows/Linux 通用)。
+    持有期間背景執行緒每 stale_after / 4 秒更新一次鎖檔時間，
+    鎖檔超過 stale_after 秒沒有更新就是前一個行程中斷時留下的，直接刪掉重搶。
+    """
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale_after:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.1)
+    released = threading.Event()
+
+    def heartbeat():
+        while not released.wait(stale_after / 4):
+            try:
+                os.utime(lock_path)
+            except OSError:
+                pass
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        yield
+    finally:
+        released.set()
+        os.close(fd)
+        os.remove(lock_path)
+
+class TextFeatureCache:
+    """
+    LongCLIP 文字特徵的持久化快取，鍵為 (權重指紋, 標籤字串)。
+    磁碟上是一個 float16 矩陣 (memmap) 和一行一個標籤的索引檔，首次查詢時才載入，執行結束時只追加新標籤。
+    """
+    def __init__(self):
+        self.features = {}
+        self.new_labels = []
+        self.cache_prefix = None
+        self.index = None
+        self.matrix = None
+
+    def open(self, cache_dir, checkpoint_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_prefix = os.path.join(cache_dir, f"longclip_{checkpoint_fingerprint(checkpoint_path)}")
+        self.index = None
+        self.matrix = None
+
+    def _read_stored(self):
+        """
+        讀取磁碟上的快取索引，返回 (dim, labels)，labels 只保留矩陣中確實有的列；沒有快取或讀取失敗時返回 None。
+        """
+        meta_path, labels_path, matrix_path = (self.cache_prefix + ext for ext in ('.json', '.labels', '.f16'))
+        if not (os.path.exists(meta_path) and os.path.exists(labels_path) and os.path.exists(matrix_path)):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                dim = json.load(f)['dim']
+            with open(labels_path, 'r', encoding='utf-8') as f:
+                labels = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Failed to load text feature cache {self.cache_prefix}: {e}")
+            return None
+        # 中途中斷時矩陣和索引可能不等長，以較短的為準
+        rows = min(len(labels), os.path.getsize(matrix_path) // (2 * dim))
+        return dim, labels[:rows]
+
+    def _load(self):
+        if self.index is not None:
+            return
+        self.index = {}
+        if self.cache_prefix is None:
+            return
+        stored = self._read_stored()
+        if stored is not None and stored[1]:
+            dim, labels = stored
+            self.matrix = np.memmap(self.cache_prefix + '.f16', dtype=np.float16, mode='r', shape=(len(labels), dim))
+            self.index = {label: i for i, label in enumerate(labels)}
+
+    def __contains__(self, label):
+        if label in self.features:
+            return True
+        self._load()
+        return label in self.index
+
+    def __getitem__(self, label):
+        if label not in self.features:
+            self._load()
+            row = self.index[label]
+            features = torch.from_numpy(np.array(self.matrix[row:row + 1]))
+            self.features[label] = features.to(device=device, dtype=clip_dtype)
+        return self.features[label]
+
+    def __setitem__(self, label, features):
+        self._load()
+        if label not in self.features and label not in self.index:
+            self.new_labels.append(label)
+        self.features[label] = features
+
+    def save(self):
+        """
+        把本次新編碼的標籤追加到磁碟快取。
+        以鎖檔和其他行程 (例如 --serve 的 worker) 互斥，並以鎖內重新讀到的磁碟內容為準，不會截掉別人剛追加的列。
+        """
+        if self.cache_prefix is None or not self.new_labels:
+            return
+        meta_path, labels_path, matrix_path = (self.cache_prefix + ext for ext in ('.json', '.labels', '.f16'))
+        # Windows 上不能截斷仍被 memmap 映射的檔案，先釋放
+        self.matrix = None
+        self.index = None
+        with file_lock(self.cache_prefix + '.lock'):
+            stored = self._read_stored()
+            stored_labels = stored[1] if stored is not None else []
+            known = set(stored_labels)
+            new_labels = [label for label in self.new_labels if label not in known]
+            if new_labels:
+                new_matrix = torch.cat([self.features[label] for label in new_labels]).float().cpu().numpy().astype(np.float16)
+                if stored is None:
+                    with open(meta_path, 'w', encoding='utf-8') as f:
+                        json.dump({'dim': new_matrix.shape[1], 'checkpoint': clip_checkpoint}, f)
+                    for path in (labels_path, matrix_path):
+                        open(path, 'w').close()
+                # 先截掉上次中斷時多寫的列，再追加矩陣，最後重寫索引
+                with open(matrix_path, 'r+b') as f:
+                    size = len(stored_labels) * new_matrix.shape[1] * 2
+                    if os.path.getsize(matrix_path) != size:
+                        f.truncate(size)
+                    f.seek(0, os.SEEK_END)
+                    f.write(new_matrix.tobytes())
+                with open(labels_path, 'w', encoding='utf-8') as f:
+                    for label in stored_labels + new_labels:
+                        f.write(json.dumps(label, ensure_ascii=False) + '\n')
+        self.new_labels = []
+
+def encode_texts(texts):
+    """
+    一次 tokenize 並編碼多段文字，返回正規化後的 (n, dim) 特徵。
+    """
+    clip_model, _ = get_clip()
+    with profiler.stage('clip_text', len(texts), cuda=True):
+        text_tensor = longclip.tokenize(texts).to(device)
+        with torch.no_grad():
+            text_features = clip_model.encode_text(text_tensor)
+            text_features = F.normalize(text_features, dim=-1)
+    return text_features
+
+def encode_images(images):
+    """
+    一次前處理並編碼多張圖片，返回正規化後的 (n, dim) LongCLIP 圖片特徵。
+    """
+    clip_model, clip_preprocess = get_clip()
+    views_list = [as_views(image) for image in images]
+    view_spec = get_view_spec('clip')
+    with profiler.stage('clip_image', len(views_list), cuda=True):
+        if view_spec is not None:
+            image_tensor = normalize_views(views_list, *view_spec)
+        else:
+            image_tensor = torch.stack([clip_preprocess(views.image) for views in views_list]).to(device)
+        with torch.no_grad():
+            image_features = clip_model.encode_image(image_tensor)
+            image_features = F.normalize(image_features, dim=-1)
+    return image_features
+
+def score_texts(image_features, texts, batch_size=64):
+    """
+    以固定大小批次編碼文字並算出與圖片的 clip score，不會把所有文字特徵同時留在記憶體。
+    """
+    scores = []
+    for i in range(0, len(texts), batch_size):
+        text_features = encode_texts(texts[i:i + batch_size])
+        with torch.no_grad():
+            scores.append((image_features @ text_features.T).squeeze(0).float().cpu().numpy())
+    return np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+
+def ensure_text_features(labels, batch_size=64):
+    """
+    批次編碼 text_features_dict 中還沒有的標籤。
+    """
+    missing_labels = list(dict.fromkeys(label for label in labels if label not in text_features_dict))
+    for i in range(0, len(missing_labels), batch_size):
+        batch_labels = missing_labels[i:i + batch_size]
+        text_features = encode_texts(batch_labels)
+        for j, label in enumerate(batch_labels):
+            text_features_dict[label] = text_features[j:j + 1]
+
+def stack_text_features(labels, cache_key=None):
+    """
+    把多個標籤的文字特徵堆成 (n, dim) 矩陣，固定的標籤表可用 cache_key 重用。
+    """
+    if cache_key is not None and cache_key in label_matrix_cache:
+        return label_matrix_cache[cache_key]
+    ensure_text_features(labels)
+    matrix = torch.cat([text_features_dict[label] for label in labels])
+    if cache_key is not None:
+        label_matrix_cache[cache_key] = matrix
+    return matrix
+
+def score_labels(image_features, labels, cache_key=None):
+    """
+    一次矩陣乘法算出所有標籤的 clip score，返回 numpy 陣列。
+    """
+    if not labels:
+        return np.zeros(0, dtype=np.float32)
+    with torch.no_grad():
+        scores = image_features @ stack_text_features(labels, cache_key).T
+    return scores.squeeze(0).float().cpu().numpy()
+
+text_features_dict = TextFeatureCache()
+worker_port = 7865
+label_matrix_cache = {}
+wd14_general_threshold = 0.2682
+wd14_character_threshold = 0.6
 lebel_word = ", is "
 clip_word = ", looks "
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
 
-def run_example(task_prompt, image, text_input=None):
-    if text_input is None:
-        prompt = task_prompt
-    else:
-        prompt = task_prompt + text_input
-    inputs = processor(text=prompt, images=image, return_tensors="pt").to(device)
+ViewSpec = namedtuple('ViewSpec', ['mode', 'width', 'height', 'resample'])
+view_specs = {}
+
+class ImageViews:
+    """
+    單張圖片的多解析度前處理快取。
+    每種 ViewSpec 只從同一張縮圖縮放一次並以 uint8 陣列保存，各模型再用 normalize_views 整批轉成張量。
+    mode 為 'resize' (直接拉伸)、'center_crop' (短邊縮放後置中裁切) 或 'pad' (白底補成正方形後縮放)。
+    """
+    def __init__(self, image):
+        self.image = image
+        self.arrays = {}
+
+    def render(self, spec):
+        image = self.image
+        if spec.mode == 'resize':
+            return image.resize((spec.width, spec.height), spec.resample)
+        if spec.mode == 'center_crop':
+            # 與 torchvision 的 Resize(int) + CenterCrop 相同
+            short, long = sorted(image.size)
+            size = (spec.width, int(spec.width * long / short)) if image.width <= image.height else (int(spec.width * long / short), spec.width)
+            image = image.resize(size, spec.resample)
+            left = int(round((image.width - spec.width) / 2.0))
+            top = int(round((image.height - spec.height) / 2.0))
+            return image.crop((left, top, left + spec.width, top + spec.height))
+        # 與 imgutils 的 WD14 前處理相同
+        max_dim = max(image.size)
+        padded_image = Image.new("RGB", (max_dim, max_dim), (255, 255, 255))
+        padded_image.paste(image, ((max_dim - image.width) // 2, (max_dim - image.height) // 2))
+        if max_dim != spec.width:
+            padded_image = padded_image.resize((spec.width, spec.height), spec.resample)
+        return padded_image
+
+    def array(self, spec):
+        array = self.arrays.get(spec)
+        if array is None:
+            array = np.asarray(self.render(spec))
+            self.arrays[spec] = array
+        return array
+
+    def warm(self, specs):
+        for spec in specs:
+            self.array(spec)
+
+    def release(self, spec):
+        self.arrays.pop(spec, None)
+
+def as_views(image):
+    return image if isinstance(image, ImageViews) else ImageViews(image)
+
+def hf_view_spec(image_processor):
+    """
+    從 transformers 的 image processor 推得 (spec, mean, std)，不支援的設定返回 None。
+    """
+    image_processor = getattr(image_processor, 'image_processor', image_processor)
+    size = getattr(image_processor, 'size', None) or {}
+    if (
+        not getattr(image_processor, 'do_resize', False)
+        or getattr(image_processor, 'do_center_crop', False)
+        or not getattr(image_processor, 'do_rescale', False)
+        or getattr(image_processor, 'rescale_factor', None) != 1 / 255
+        or not getattr(image_processor, 'do_normalize', False)
+        or 'height' not in size or 'width' not in size
+    ):
+        return None
+    spec = ViewSpec('resize', size['width'], size['height'], int(image_processor.resample))
+    return spec, list(image_processor.image_mean), list(image_processor.image_std)
+
+def torchvision_view_spec(transform):
+    """
+    從 LongCLIP 的 torchvision Compose (Resize, CenterCrop, ToTensor, Normalize) 推得 (spec, mean, std)，不支援時返回 None。
+    """
+    steps = {}
+    for step in getattr(transform, 'transforms', []):
+        name = type(step).__name__
+        if name in ('Resize', 'CenterCrop', 'ToTensor', 'Normalize'):
+            steps[name] = step
+        elif name != 'function':
+            return None
+    if set(steps) != {'Resize', 'CenterCrop', 'ToTensor', 'Normalize'}:
+        return None
+    resize_size = steps['Resize'].size
+    resize_size = resize_size if isinstance(resize_size, int) else resize_size[0] if len(resize_size) == 1 else None
+    crop_height, crop_width = steps['CenterCrop'].size
+    resample = getattr(Image, steps['Resize'].interpolation.value.upper(), None)
+    if resize_size is None or resize_size != crop_width or crop_width != crop_height or steps['Resize'].max_size is not None or resample is None:
+        return None
+    spec = ViewSpec('center_crop', crop_width, crop_height, resample)
+    return spec, list(steps['Normalize'].mean), list(steps['Normalize'].std)
+
+def get_view_spec(name):
+    """
+    返回模型 name 對應的 (spec, mean, std)，首次呼叫時從 preprocessor 推得；無法對應時為 None，改走原本的 preprocessor。
+    """
+    if name not in view_specs:
+        if name == 'florence':
+            spec = hf_view_spec(get_florence()[1])
+        elif name == 'clip':
+            spec = torchvision_view_spec(get_clip()[1])
+        elif name == 'aesthetic':
+            spec = hf_view_spec(get_aesthetic()[1])
+        else:
+            spec = wd14_tagger.view_spec()
+        view_specs[name] = spec
+    return view_specs[name]
+
+def active_view_specs():
+    """
+    目前已載入模型用到的 spec，讀圖執行緒據此預先縮圖。
+    """
+    return [spec[0] for spec in list(view_specs.values()) if spec is not None]
+
+def normalize_views(views_list, spec, mean, std):
+    """
+    將多張圖片的 uint8 快取堆疊後送上裝置，再整批做 rescale 與 normalize，返回 NCHW 的 float32 張量。
+    """
+    batch = torch.from_numpy(np.stack([views.array(spec) for views in views_list])).to(device)
+    batch = batch.permute(0, 3, 1, 2).float().div_(255)
+    mean = torch.tensor(mean, device=device).view(1, -1, 1, 1)
+    std = torch.tensor(std, device=device).view(1, -1, 1, 1)
+    return batch.sub_(mean).div_(std)
+
+def parse_florence_answer(task_prompt, parsed_answer):
+    """
+    將 Florence-2 post_process_generation 的結果轉成 caption 與 bboxes。
+    """
     bboxes = []
-    # 將inputs轉換為fp16
-    inputs["pixel_values"] = inputs["pixel_values"].half()
-    
-    with torch.cuda.amp.autocast():
-        generated_ids = model.generate(
-            input_ids=inputs["input_ids"],
-            pixel_values=inputs["pixel_values"],
-            max_new_tokens=1024,
-            num_beams=3
-        )
-        
-    generated_text = processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
-    parsed_answer = processor.post_process_generation(
-        generated_text,
-        task=task_prompt,
-        image_size=(image.width, image.height)
-    )
-    
     if task_prompt == '<DENSE_REGION_CAPTION>':
         dense_labels = parsed_answer['<DENSE_REGION_CAPTION>']['labels']
         caption = ', '.join([label for label in dense_labels if label.count(' ') > 1])
@@ -114,7 +688,69 @@ def run_example(task_prompt, image, text_input=None):
             return caption[:-1], bboxes
     return caption, bboxes
 
-def get_aesthetic_tag(image):
+florence_prompt_ids = {}
+
+def get_florence_prompt_ids(processor, prompt, view_spec):
+    """
+    prompt 經 Florence-2 processor 轉成的 input_ids (1, L)，依 prompt 字串快取。
+    透過公開的 processor(text=..., images=...) 取得，圖片只是同尺寸的佔位圖，之後批次直接沿用並換上預先縮好的 pixel_values。
+    """
+    if prompt not in florence_prompt_ids:
+        placeholder = Image.new('RGB', (view_spec[0].width, view_spec[0].height))
+        florence_prompt_ids[prompt] = processor(text=[prompt], images=[placeholder], return_tensors="pt")["input_ids"]
+    return florence_prompt_ids[prompt]
+
+def run_example_batch(task_prompt, images, text_input=None):
+    """
+    一次對多張圖片執行 Florence-2，返回每張圖片的 (caption, bboxes)。
+    """
+    if text_input is None:
+        prompt = task_prompt
+    else:
+        prompt = task_prompt + text_input
+    model, processor = get_florence()
+    with profiler.stage('florence', len(images), cuda=True):
+        views_list = [as_views(image) for image in images]
+        view_spec = get_view_spec('florence')
+        if view_spec is not None:
+            # 整批用同一個 prompt，input_ids 長度相同不需要 padding
+            inputs = {
+                "input_ids": get_florence_prompt_ids(processor, prompt, view_spec).repeat(len(views_list), 1).to(device),
+                "pixel_values": normalize_views(views_list, *view_spec),
+            }
+        else:
+            inputs = processor(text=[prompt] * len(views_list), images=[views.image for views in views_list], return_tensors="pt", padding=True).to(device)
+        # 將inputs轉換為fp16
+        inputs["pixel_values"] = inputs["pixel_values"].half()
+    
+        with torch.cuda.amp.autocast():
+            generated_ids = model.generate(
+                input_ids=inputs["input_ids"],
+                pixel_values=inputs["pixel_values"],
+                max_new_tokens=1024,
+                num_beams=3
+            )
+        
+        generated_texts = processor.batch_decode(generated_ids, skip_special_tokens=False)
+        results = []
+        for generated_text, views in zip(generated_texts, views_list):
+            # 批次中較短的輸出會被補上 pad token，需先移除
+            generated_text = generated_text.replace(processor.tokenizer.pad_token, '')
+            parsed_answer = processor.post_process_generation(
+                generated_text,
+                task=task_prompt,
+                image_size=(views.image.width, views.image.height)
+            )
+            results.append(parse_florence_answer(task_prompt, parsed_answer))
+    return results
+
+def run_example(task_prompt, image, text_input=None):
+    return run_example_batch(task_prompt, [image], text_input)[0]
+
+def get_aesthetic_tags(images):
+    """
+    一次前向傳播為多張圖片打美學分數，返回每張圖片的美學標籤。
+    """
     def aesthetic_tag(score):
         if score >= 6:
             return "aesthetic."
@@ -124,15 +760,86 @@ def get_aesthetic_tag(image):
             return "bad."
         else:
             return "garbage."
-    pixel_values = (
-        aes_preprocessor(images=image, return_tensors="pt")
-        .pixel_values.to(torch.bfloat16)
-        .to(device)
-    )
-    with torch.inference_mode():
-        score = aes_model(pixel_values).logits.squeeze().float().cpu().numpy()
-        aestag = aesthetic_tag(score)
-    return aestag
+    aes_model, aes_preprocessor = get_aesthetic()
+    with profiler.stage('aesthetic', len(images), cuda=True):
+        views_list = [as_views(image) for image in images]
+        view_spec = get_view_spec('aesthetic')
+        if view_spec is not None:
+            pixel_values = normalize_views(views_list, *view_spec).to(torch.bfloat16)
+        else:
+            pixel_values = (
+                aes_preprocessor(images=[views.image for views in views_list], return_tensors="pt")
+                .pixel_values.to(torch.bfloat16)
+                .to(device)
+            )
+        with torch.inference_mode():
+            scores = aes_model(pixel_values).logits.float().cpu().numpy().reshape(-1)
+    return [aesthetic_tag(score) for score in scores]
+
+def get_aesthetic_tag(image):
+    return get_aesthetic_tags([image])[0]
+
+class WD14BatchTagger:
+    """
+    共用一個 onnxruntime session 批次執行 WD14 tagger，輸出與 get_wd14_tags 相同的 (rating, features, chars)。
+    imgutils 內部介面不可用時退回逐張呼叫 get_wd14_tags。
+    """
+    def __init__(self, general_threshold=wd14_general_threshold, character_threshold=wd14_character_threshold):
+        self.model_name = inspect.signature(get_wd14_tags).parameters['model_name'].default
+        self.general_threshold = general_threshold
+        self.character_threshold = character_threshold
+        self.session = None
+        self.fallback = False
+
+    def _load(self):
+        if self.session is not None or self.fallback:
+            return
+        try:
+            from imgutils.tagging.wd14 import _get_wd14_model, _get_wd14_labels
+            self.session = _get_wd14_model(self.model_name)
+            self.tag_names, self.rating_indexes, self.general_indexes, self.character_indexes = _get_wd14_labels(self.model_name)[:4]
+            self.target_size = self.session.get_inputs()[0].shape[1]
+            self.input_name = self.session.get_inputs()[0].name
+            self.output_name = self.session.get_outputs()[0].name
+        except (ImportError, TypeError, ValueError) as e:
+            print(f"WD14 batch tagging unavailable, falling back to get_wd14_tags: {e}")
+            self.session = None
+            self.fallback = True
+
+    def view_spec(self):
+        self._load()
+        if self.fallback:
+            return None
+        return ViewSpec('pad', self.target_size, self.target_size, Image.BICUBIC), None, None
+
+    def _postprocess(self, preds):
+        labels = list(zip(self.tag_names, preds.astype(float).tolist()))
+        rating = {labels[i][0]: labels[i][1] for i in self.rating_indexes}
+        features = dict(labels[i] for i in self.general_indexes if labels[i][1] > self.general_threshold)
+        features = drop_overlap_tags(features)
+        chars = dict(labels[i] for i in self.character_indexes if labels[i][1] > self.character_threshold)
+        return rating, features, chars
+
+    def tag(self, images):
+        self._load()
+        with profiler.stage('wd14', len(images)):
+            views_list = [as_views(image) for image in images]
+            if self.fallback:
+                return [
+                    get_wd14_tags(views.image, character_threshold=self.character_threshold, general_threshold=self.general_threshold, drop_overlap=True)
+                    for views in views_list
+                ]
+            # 模型輸入為 BGR、0~255 的 float32
+            spec = get_view_spec('wd14')[0]
+            batch = np.ascontiguousarray(np.stack([views.array(spec) for views in views_list]).astype(np.float32)[..., ::-1])
+            try:
+                preds = self.session.run([self.output_name], {self.input_name: batch})[0]
+            except Exception:
+                # 部分匯出的模型 batch 維度固定為 1
+                preds = np.concatenate([self.session.run([self.output_name], {self.input_name: batch[i:i + 1]})[0] for i in range(len(batch))])
+        return [self._postprocess(pred) for pred in preds]
+
+wd14_tagger = WD14BatchTagger()
 
 def generate_special_text(image_path, args, features=None, chars=None):
     """
@@ -215,7 +922,7 @@ def generate_special_text(image_path, args, features=None, chars=None):
 
     return f"{'include ' if chartags else ''}{' and '.join(chartags)}", ', '.join(chartags), boorutag, artisttag
     
-def calculate_best_labels(image, short_caption, long_caption, image_path): 
+def calculate_best_labels(image, short_caption, long_caption, image_path, args, image_features=None): 
     def contains_color(tag: str) -> bool:
         colors = {'red', 'orange', 'yellow', 'green', 'blue', 'aqua', 'purple', 'brown', 'pink', 'black', 'white', 'grey', 'dark ', 'light ', 'blonde'}
         return any(color in tag for color in colors)
@@ -252,23 +959,19 @@ def calculate_best_labels(image, short_caption, long_caption, image_path):
         return selected_labels        
 
     def find_best_pair(image_features, labels, init_text=None):
-        best_score = float('-inf')
-        best_pair = []
-
-        for i, label1 in enumerate(labels):
-            for j, label2 in enumerate(labels):
-                if i != j:
-                    combined_text = f'{init_text} {label1}, {label2}' if init_text else f'{label1}, {label2}'
-                    text_tensor = longclip.tokenize([combined_text]).to(device)
-                    with torch.no_grad():
-                        text_features = clip_model.encode_text(text_tensor)
-                        text_features = F.normalize(text_features, dim=-1)
-                        logits_per_image = (image_features @ text_features.T).item()
-                    if logits_per_image > best_score:
-                        best_score = logits_per_image
-                        best_pair = [label1, label2]
-
-        return best_pair, best_score
+        # 同一輪的候選句一起 tokenize，按 text_batch_size 分批編碼
+        pairs = [
+            (label1, label2)
+            for i, label1 in enumerate(labels)
+            for j, label2 in enumerate(labels)
+            if (i < j if args.unordered_pairs else i != j)
+        ]
+        if not pairs:
+            return [], float('-inf')
+        combined_texts = [f'{init_text} {label1}, {label2}' if init_text else f'{label1}, {label2}' for label1, label2 in pairs]
+        scores = score_texts(image_features, combined_texts, args.text_batch_size)
+        best_index = int(np.argmax(scores))
+        return list(pairs[best_index]), float(scores[best_index])
 
     def find_best_combined_text(image_features, labels, init_text=None, _iter=10):
         best_labels = []
@@ -287,10 +990,9 @@ def calculate_best_labels(image, short_caption, long_caption, image_path):
 
         return best_labels
 
-    image_tensor = clip_preprocess(image).unsqueeze(0).to(device)
-    with torch.no_grad():
-        image_features = clip_model.encode_image(image_tensor)
-        image_features = F.normalize(image_features, dim=-1) 
+    # 管線中已批次編碼過的圖片直接傳入 image_features
+    if image_features is None:
+        image_features = encode_images([image])
         
     labels, long_labels, clothes_labels, people_labels = [], [], [], []
     clothtag, persontag, peopletag, custom_keeptag = '', '', '', ''
@@ -304,32 +1006,15 @@ def calculate_best_labels(image, short_caption, long_caption, image_path):
     is_solo = False 
     is_solo = "solo" in short_caption
     
-    for label in labels + long_labels + preson_labels:
-        if label not in text_features_dict:
-            text_tensor = longclip.tokenize([label]).to(device)
-            with torch.no_grad():
-                text_features = clip_model.encode_text(text_tensor)
-                text_features = F.normalize(text_features, dim=-1)
-            text_features_dict[label] = text_features
-
-    clip_scores = []
-    for label in clip_labels:
-        with torch.no_grad():
-            logits_per_image = (image_features @ text_features_dict[label].T).item()
-            clip_scores.append((label, logits_per_image))
-    
-    clip_scores.sort(key=lambda x: x[1], reverse=True)
-    top_clip_labels = [clip_scores[0][0], clip_scores[1][0], clip_scores[3][0]] 
+    ensure_text_features(labels + long_labels + preson_labels)
+
+    clip_scores = score_labels(image_features, clip_labels, 'clip_labels')
+    top_clip_indices = np.argsort(-clip_scores, kind='stable')[:4]
+    top_clip_labels = [clip_labels[top_clip_indices[0]], clip_labels[top_clip_indices[1]], clip_labels[top_clip_indices[3]]] 
 
     if not is_solo:
-        preson_scores = []
-        for label in preson_labels:
-            with torch.no_grad():
-                logits_per_image = (image_features @ text_features_dict[label].T).item()
-                preson_scores.append((label, logits_per_image))
-        
-        preson_scores.sort(key=lambda x: x[1], reverse=True)
-        persontag = preson_scores[0][0]
+        preson_scores = score_labels(image_features, preson_labels, 'preson_labels')
+        persontag = preson_labels[int(np.argmax(preson_scores))]
         if persontag == 'focus on one person':
             is_solo = True
             
@@ -355,14 +1040,9 @@ def calculate_best_labels(image, short_caption, long_caption, image_path):
         labels = [label for label in labels if label.replace(lebel_word, "") not in custom_keeptags]         
 
     labels = list(set(labels + top_clip_labels + long_labels))
-    label_scores = []
     image_info=[]
     image_info = [image_path, image_features, labels]
-
-    for label in labels:
-        with torch.no_grad():
-            logits_per_image = (image_features @ text_features_dict[label].T).item()
-        label_scores.append((label, logits_per_image))
+    label_scores = list(zip(labels, score_labels(image_features, labels).tolist()))
         
     average_score = sum(score for _, score in label_scores) / len(label_scores)
 
@@ -398,127 +1078,514 @@ def calculate_best_labels(image, short_caption, long_caption, image_path):
   
     return selected_labels, final_score, clothtag, persontag, peopletag, custom_keeptag, image_info
 
-def process_image(image_path, folder_chartag, args):
+def resize_image(image_path, max_size=448):
     """
-    處理單個圖片，獲取標籤並存儲。修改以支持多進程數據傳遞。
+    縮小圖像使其最大邊不超過 max_size，返回縮小後的 RGB 圖像數據。
+    JPEG 先用 draft() 在解碼時直接以 1/2~1/8 縮小，再以整數倍 reduce 快速縮到接近目標後做 LANCZOS，
+    WD14、LongCLIP、美學和 Florence-2 都從這一次解碼的結果取圖。
     """
+    image = Image.open(image_path)
+    if max(image.width, image.height) > max_size:
+        if image.width > image.height:
+            new_width = max_size
+            new_height = int(max_size * image.height / image.width)
+        else:
+            new_height = max_size
+            new_width = int(max_size * image.width / image.height)
+        # draft 只會縮到不小於要求的尺寸，對非 JPEG 無作用
+        image.draft('RGB', (new_width, new_height))
+        image = image.resize((new_width, new_height), Image.LANCZOS, reducing_gap=3.0)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
 
-    def resize_image(image_path, max_size=448):
+def is_recently_captioned(image_path, args):
+    """
+    檢查標籤文件是否在 continue_caption 天內修改過
+    """
+    tag_file_path = Path(image_path).with_suffix('').with_suffix('.txt')
+    if tag_file_path.exists():
+        last_modified_time = datetime.fromtimestamp(tag_file_path.stat().st_mtime)
+        if datetime.now() - last_modified_time < timedelta(days=args.continue_caption):
+            return True
+    return False
+
+def run_batch_models(results, args):
+    """
+    對已讀好的圖片批次執行可批次化的模型 (WD14, 美學, Florence-2, LongCLIP 圖片編碼)。
+    results 為 {image_path: {'views'}}，結果填回 'wd14', 'aestag', 'caption', 'clip_features'。
+    各 stage 用完後釋放該模型的縮圖快取。
+    """
+    pending_paths = list(results)
+
+    def release(name, batch_paths):
+        view_spec = view_specs.get(name)
+        if view_spec is not None:
+            for image_path in batch_paths:
+                results[image_path]['views'].release(view_spec[0])
+
+    # 批次失敗時不填結果，交由 process_image 逐張處理
+    for i in range(0, len(pending_paths), args.wd14_batch_size):
+        batch_paths = pending_paths[i:i + args.wd14_batch_size]
+        try:
+            tags = wd14_tagger.tag([results[image_path]['views'] for image_path in batch_paths])
+        except Exception as e:
+            print(f"Failed to tag batch starting at {batch_paths[0]}: {e}")
+            continue
+        for image_path, wd14_result in zip(batch_paths, tags):
+            results[image_path]['wd14'] = wd14_result
+        release('wd14', batch_paths)
+
+    aes_paths = [] if args.skip_aesthetic else pending_paths
+    for i in range(0, len(aes_paths), args.aes_batch_size):
+        batch_paths = aes_paths[i:i + args.aes_batch_size]
+        try:
+            aestags = get_aesthetic_tags([results[image_path]['views'] for image_path in batch_paths])
+        except Exception as e:
+            print(f"Failed to score aesthetic batch starting at {batch_paths[0]}: {e}")
+            continue
+        for image_path, aestag in zip(batch_paths, aestags):
+            results[image_path]['aestag'] = aestag
+        release('aesthetic', batch_paths)
+
+    caption_paths = [] if args.skip_florence else pending_paths
+    for i in range(0, len(caption_paths), args.caption_batch_size):
+        batch_paths = caption_paths[i:i + args.caption_batch_size]
+        try:
+            captions = run_example_batch('<MORE_DETAILED_CAPTION>', [results[image_path]['views'] for image_path in batch_paths])
+        except Exception as e:
+            print(f"Failed to caption batch starting at {batch_paths[0]}: {e}")
+            continue
+        for image_path, (more_detailed_caption, _) in zip(batch_paths, captions):
+            results[image_path]['caption'] = more_detailed_caption
+        release('florence', batch_paths)
+
+    for i in range(0, len(pending_paths), args.clip_batch_size):
+        batch_paths = pending_paths[i:i + args.clip_batch_size]
+        try:
+            image_features = encode_images([results[image_path]['views'] for image_path in batch_paths])
+        except Exception as e:
+            print(f"Failed to encode image batch starting at {batch_paths[0]}: {e}")
+            continue
+        for j, image_path in enumerate(batch_paths):
+            results[image_path]['clip_features'] = image_features[j:j + 1]
+        release('clip', batch_paths)
+    return results
+
+def iter_preprocessed(image_paths, args):
+    """
+    管線前段：執行緒池讀圖縮圖 → 模型 stage 批次推論，兩段之間以有界佇列銜接。
+    依 image_paths 原順序產出 (image_path, precomputed)，讀圖失敗或略過的圖片 precomputed 為 None。
+    """
+    decoded_queue = queue.Queue(maxsize=args.decode_queue_depth)
+    model_queue = queue.Queue(maxsize=args.model_queue_depth)
+    batch_size = max(args.caption_batch_size, args.wd14_batch_size, args.aes_batch_size, args.clip_batch_size)
+    stop_event = threading.Event()
+    errors = []
+
+    def load_image(image_path):
+        if is_recently_captioned(image_path, args):
+            return None
+        try:
+            with profiler.stage('decode'):
+                views = ImageViews(resize_image(image_path))
+                # 模型已載入後，各模型需要的縮圖也在讀圖執行緒中先做好
+                views.warm(active_view_specs())
+            return views
+        except Exception as e:
+            print(f"Failed to load image {image_path}: {e}")
+            return None
+
+    def put(target_queue, item):
+        # 消費端提前結束時避免永久阻塞
+        while not stop_event.is_set():
+            try:
+                target_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(source_queue):
+        # 消費端提前結束時上游可能送不出結束標記，不能無限等待，停止時視同收到 None
+        while not stop_event.is_set():
+            try:
+                return source_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return None
+
+    def decode_stage():
+        try:
+            with ThreadPoolExecutor(max_workers=args.decode_workers) as pool:
+                pending = deque()
+                try:
+                    for image_path in image_paths:
+                        pending.append((image_path, pool.submit(load_image, image_path)))
+                        if len(pending) >= args.decode_queue_depth:
+                            image_path, future = pending.popleft()
+                            if not put(decoded_queue, (image_path, future.result())):
+                                return
+                    while pending:
+                        image_path, future = pending.popleft()
+                        if not put(decoded_queue, (image_path, future.result())):
+                            return
+                finally:
+                    # 提前結束時取消還沒開始讀的圖片，關閉執行緒池只需等正在讀的
+                    for _, future in pending:
+                        future.cancel()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(decoded_queue, None)
+
+    def model_stage():
+        try:
+            finished = False
+            while not finished:
+                batch = []
+                while len(batch) < batch_size:
+                    item = get(decoded_queue)
+                    if item is None:
+                        finished = True
+                        break
+                    batch.append(item)
+                results = {image_path: {'views': views} for image_path, views in batch if views is not None}
+                run_batch_models(results, args)
+                for image_path, _ in batch:
+                    if not put(model_queue, (image_path, results.get(image_path))):
+                        return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(model_queue, None)
+
+    threads = [threading.Thread(target=decode_stage, daemon=True), threading.Thread(target=model_stage, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = model_queue.get()
+            if item is None:
+                break
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+def caption_writer(write_queue):
+    """
+    寫檔執行緒：把 (tag_file_path, tags_text, current_texts) 寫成 txt，收到 None 時結束。
+    現有檔案的內容已在 current_texts 中 (None 時為 tags_text) 就不重寫，沿用 manifest 的圖片不會每次都改到 txt。
+    """
+    while True:
+        item = write_queue.get()
+        try:
+            if item is None:
+                return
+            tag_file_path, tags_text, current_texts = item
+            with profiler.stage('write'):
+                try:
+                    with open(tag_file_path, 'r', encoding='utf-8') as f:
+                        if f.read() in (current_texts or (tags_text,)):
+                            continue
+                except (OSError, UnicodeDecodeError):
+                    pass
+                with open(tag_file_path, 'w', encoding='utf-8') as f:
+                    f.write(tags_text)
+        except Exception as e:
+            print(f"Failed to write {item[0]}: {e}")
+        finally:
+            write_queue.task_done()
+
+
+def build_folder_chartag(text, folder_chartag, chartags):
+    """
+    构建folder_chartag字典
+    输入: 字符串text, generate_special_text 返回的角色標籤字串chartags (以子字串比對)
+    输出: folder_chartag字典
+    """
+    tags = [tag.strip() for tag in text.split(',')]
+    folder_chartag = {} if folder_chartag is None else folder_chartag
+    
+    for tag in tags:
+        if tag in chartags:
+            if tag in folder_chartag:
+                folder_chartag[tag] += 1
+            else:
+                folder_chartag[tag] = 1
+                
+    return folder_chartag
+
+def caption_options_key(args):
+    """
+    影響單張圖片打標結果的參數，參數不同時 manifest 中的結果不能重用。
+    """
+    options = {name: getattr(args, name) for name in (
+        'folder_name', 'not_char', 'drop_colortag', 'clothtag', 'peopletag', 'custom_keeptag', 'debiased',
+        'rawdata', 'clustertag', 'unordered_pairs', 'skip_florence', 'skip_aesthetic'
+    )}
+    return json.dumps(options, sort_keys=True, ensure_ascii=False)
+
+class ImageFeatureStore:
+    """
+    每個資料夾一份 LongCLIP 圖片特徵：float16 原始矩陣 (.clip_features.f16，可直接 memmap) 和索引 (.clip_features.json)。
+    打標時逐列追加到暫存檔，資料夾結束時換成正式檔；資料夾層級的刪標和之後的聚類、去重都從這裡讀，
+    不必把每張圖的特徵張量留在記憶體。沒有重新編碼的圖片用 carry 沿用上次的特徵。
+    """
+    prefix_name = '.clip_features'
+
+    def __init__(self, folder):
+        self.prefix = os.path.join(folder, self.prefix_name)
+        self.previous, self.previous_index = self.load(folder)
+        self.names = []
+        self.dim = None
+        self.tmp_file = None
+
+    @classmethod
+    def load(cls, folder):
         """
-        縮小圖像使其最大邊不超過 max_size，返回縮小後的圖像數據
+        讀取資料夾的特徵，返回 (float16 memmap 矩陣, {檔名: 列})，沒有或損壞時返回 (None, {})
         """
-        image = Image.open(image_path)
-        if max(image.width, image.height) > max_size:
-            if image.width > image.height:
-                new_width = max_size
-                new_height = int(max_size * image.height / image.width)
-            else:
-                new_height = max_size
-                new_width = int(max_size * image.width / image.height)
-            image = image.resize((new_width, new_height), Image.LANCZOS)
-        return image
+        prefix = os.path.join(folder, cls.prefix_name)
+        meta_path, matrix_path = prefix + '.json', prefix + '.f16'
+        if not (os.path.exists(meta_path) and os.path.exists(matrix_path)):
+            return None, {}
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            dim, names = meta['dim'], meta['names']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Failed to load image feature store {prefix}: {e}")
+            return None, {}
+        # 中途中斷時矩陣和索引可能不等長，以較短的為準
+        rows = min(len(names), os.path.getsize(matrix_path) // (2 * dim))
+        if not rows:
+            return None, {}
+        matrix = np.memmap(matrix_path, dtype=np.float16, mode='r', shape=(rows, dim))
+        return matrix, {name: i for i, name in enumerate(names[:rows])}
 
-    def process_features(features: dict) -> (dict, str):
+    def _append(self, name, row):
+        row = np.ascontiguousarray(row, dtype=np.float16).reshape(-1)
+        if self.tmp_file is None:
+            self.dim = row.shape[0]
+            self.tmp_file = open(self.prefix + '.f16.tmp', 'wb')
+        self.tmp_file.write(row.tobytes())
+        self.names.append(name)
+        return row
+
+    def add(self, image_path, image_features):
         """
-        處理features字典，移除指定模式的鍵值對並生成keep_tags字串。
-        
-        參數:
-        features (dict): 包含特徵的字典。
-
-        返回:
-        (dict, str): 返回處理後的features字典和keep_tags字串。
-        """        
-        patterns_to_keep = [
-            r'^anime.*$', r'^monochrome$', r'^.*background$', r'^comic$', r'^greyscale$', r'^sketch$', 
-            r'^.*censor.*$', r'^.*_name$', r'^signature$', r'^.*_username$', r'^.*text.*$', 
-            r'^.*_bubble$', r'^multiple_views$', r'^.*blurry.*$', r'^.*koma$', r'^watermark$', 
-            r'^traditional_media$', r'^parody$', r'^.*cover$', r'^.*_theme$', r'^.*realistic$', 
-            r'^oekaki$', r'^3d$', r'^.*chart$', r'^letterboxed$', r'^variations$', r'^.*mosaic.*$', 
-            r'^omake$', r'^column.*$', r'^.*_(medium)$', r'^manga$', r'^lineart$', r'^.*logo$'            
-            #r'^(from_side|from_behind|from_above|from_below)$', r'^(close_up|dutch_angle|downblouse|downpants|pantyshot|upskirt|atmospheric_perspective|fisheye|panorama|perspective|pov|rotated|sideways|upside_down|vanishing_point|straight-on)$', r'^(face|cowboy_shot|portrait|upper_body|lower_body|feet_out_of_frame|full_body|wide_shot|very_wide_shot|cut_in|cropped_legs|head_out_of_frame|cropped_torso|cropped_arms|cropped_shoulders|profile|group_profile)$', r'^(armpit_focus|ass_focus|back_focus|breast_focus|eye_focus|foot_focus|hand_focus|hip_focus|navel_focus|pectoral_focus|thigh_focus|soft_focus|solo_focus)$'
-        ]
-        keep_tags_set = set()
-        if 'solo' in features or 'solo_focus' in features:
-            patterns_to_keep.extend([r'^holding_.*$'])
-            #, r'^.*grab.*$', r'^.*lift.*$', r'^.*pull$', r'^.*_own_.*$', r'^.*covered.*$', r'^.*_masturbation.*$', r'^.*out.*$', r'^.*_between_.*$'
-        keys = list(features.keys())
-        keys_to_delete = []
-        
-        for key in keys:
-            for pattern in patterns_to_keep:
-                regex = re.compile(pattern)
-                if regex.match(key):
-                    keep_tags_set.add(key.replace('_', ' '))
-                    keys_to_delete.append(key)
-                    
-        lying_conditions = ['on_stomach', 'on_back', 'on_side']
-        if 'lying' in keys and any(cond in keys for cond in lying_conditions):
-            for cond in lying_conditions:
-                if cond in keys:
-                    features[f'lying_{cond}'] = 0
-                    keys_to_delete.append(cond)
-            keys_to_delete.append('lying')
-            
-        boygirl_tags = [tag for tag in keys if tag in {'multiple_girls', '1girl', 'multiple_boys', '1boy'}]
-        if boygirl_tags:
-            feature_key = ' '.join(sorted(boygirl_tags))
-            features[feature_key] = 0
-            for tag in boygirl_tags:
-                keys_to_delete.append(tag)           
-
-        for key in keys_to_delete:
-            if key in features:
-                del features[key]
-        
-        keep_tags = ', '.join(keep_tags_set).rstrip(', ')
-        
-        return features, keep_tags
+        追加一張圖的特徵，返回存下的 float16 列
+        """
+        return self._append(os.path.basename(image_path), image_features.float().cpu().numpy())
+
+    def carry(self, image_path):
+        """
+        沿用上次的特徵並返回該列，上次沒有這張圖時返回 None
+        """
+        row = self.previous_index.get(os.path.basename(image_path))
+        if row is None:
+            return None
+        # 複製出來，不留住舊 memmap 的參照
+        return self._append(os.path.basename(image_path), np.array(self.previous[row]))
+
+    def finish(self):
+        """
+        暫存檔換成正式檔並返回 load() 的結果，這次沒有任何特徵時保留舊檔並返回 (None, {})
+        """
+        # 先放掉舊的 memmap，Windows 上才能取代檔案
+        self.previous, self.previous_index = None, {}
+        if self.tmp_file is None:
+            return None, {}
+        self.tmp_file.close()
+        self.tmp_file = None
+        os.replace(self.prefix + '.f16.tmp', self.prefix + '.f16')
+        tmp_path = self.prefix + '.json.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'dim': self.dim, 'names': self.names}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.prefix + '.json')
+        return self.load(os.path.dirname(self.prefix))
+
+class CaptionManifest:
+    """
+    每個資料集根目錄一份 manifest，以圖片內容雜湊和打標參數為鍵，保存每張圖在資料夾層級處理前的打標結果。
+    檔案大小和修改時間沒變時直接沿用記錄的雜湊，不重讀圖片。圖片特徵不在這裡，沿用時從資料夾的 ImageFeatureStore 取。
+    """
+    filename = '.caption_manifest.json'
+    version = 3
+
+    def __init__(self, root, args):
+        self.path = os.path.join(root, self.filename)
+        self.root = root
+        self.options_key = caption_options_key(args)
+        self.entries = {}
+        self.seen = set()
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                # 第 1 版把特徵存在 manifest 內，沒有對應的 ImageFeatureStore；第 2 版沒有記錄 chartags，都全部重打
+                if manifest.get('version') == self.version:
+                    self.entries = manifest.get('images', {})
+            except (OSError, ValueError) as e:
+                print(f"Failed to load manifest {self.path}: {e}")
 
-    def build_folder_chartag(text, folder_chartag):
+    def _key(self, image_path):
+        return Path(os.path.relpath(image_path, self.root)).as_posix()
+
+    @staticmethod
+    def _content_hash(image_path):
+        sha = hashlib.sha1()
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def lookup(self, image_path):
         """
-        构建folder_chartag字典
-        输入: 字符串text, 集合chartags
-        输出: folder_chartag字典
+        圖片內容和參數都沒變時返回記錄，否則返回 None。
         """
-        tags = [tag.strip() for tag in text.split(',')]
-        folder_chartag = {} if folder_chartag is None else folder_chartag
+        key = self._key(image_path)
+        self.seen.add(key)
+        entry = self.entries.get(key)
+        if not entry or entry['options'] != self.options_key:
+            return None
+        stat = os.stat(image_path)
+        if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            if entry['size'] != stat.st_size or self._content_hash(image_path) != entry['hash']:
+                return None
+            entry['mtime_ns'] = stat.st_mtime_ns
+            self.dirty = True
+        return entry
+
+    def update(self, image_path, tags_text, final_score, chartag_text, chartags, image_info):
+        key = self._key(image_path)
+        stat = os.stat(image_path)
+        self.seen.add(key)
+        self.dirty = True
+        self.entries[key] = {
+            'hash': self._content_hash(image_path),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'options': self.options_key,
+            'tags_text': tags_text,
+            'final_score': final_score,
+            'chartag_text': chartag_text,
+            'chartags': chartags,
+            'labels': image_info[2],
+        }
+
+    def save(self, prune=False):
+        """
+        每個資料夾處理完存一次，中斷後重跑可沿用已完成的資料夾；沒有變更時不寫檔。
+        prune 時只保留這次有看到的圖片，刪掉的圖片不會留在 manifest，只在整個資料集處理完後使用。
+        """
+        if prune:
+            entries = {key: entry for key, entry in self.entries.items() if key in self.seen}
+            if len(entries) == len(self.entries) and not self.dirty:
+                return
+            self.entries = entries
+        elif not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.version, 'images': self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+def process_features(features: dict) -> (dict, str):
+    """
+    處理features字典，移除指定模式的鍵值對並生成keep_tags字串。
+    
+    參數:
+    features (dict): 包含特徵的字典。
+
+    返回:
+    (dict, str): 返回處理後的features字典和keep_tags字串。
+    """        
+    keep_tags_set = set()
+    rules = solo_keep_tag_rules if 'solo' in features or 'solo_focus' in features else keep_tag_rules
+    keys = list(features.keys())
+    keys_to_delete = []
+    
+    for key in keys:
+        if rules.matches(key):
+            keep_tags_set.add(key.replace('_', ' '))
+            keys_to_delete.append(key)
+                
+    lying_conditions = ['on_stomach', 'on_back', 'on_side']
+    if 'lying' in keys and any(cond in keys for cond in lying_conditions):
+        for cond in lying_conditions:
+            if cond in keys:
+                features[f'lying_{cond}'] = 0
+                keys_to_delete.append(cond)
+        keys_to_delete.append('lying')
         
-        for tag in tags:
-            if tag in chartags:
-                if tag in folder_chartag:
-                    folder_chartag[tag] += 1
-                else:
-                    folder_chartag[tag] = 1
-                    
-        return folder_chartag
+    boygirl_tags = [tag for tag in keys if tag in {'multiple_girls', '1girl', 'multiple_boys', '1boy'}]
+    if boygirl_tags:
+        feature_key = ' '.join(sorted(boygirl_tags))
+        features[feature_key] = 0
+        for tag in boygirl_tags:
+            keys_to_delete.append(tag)           
+
+    for key in keys_to_delete:
+        if key in features:
+            del features[key]
     
+    keep_tags = ', '.join(keep_tags_set).rstrip(', ')
+    
+    return features, keep_tags
+
+def process_image(image_path, folder_chartag, args, precomputed=None, captions=None, manifest=None):
+    """
+    處理單個圖片，獲取標籤並存儲。修改以支持多進程數據傳遞。
+    """
+
     tag_file_path = Path(image_path).with_suffix('').with_suffix('.txt')
 
     # 檢查文件最後修改時間，如果在一周內則略過
-    if tag_file_path.exists():
-        last_modified_time = datetime.fromtimestamp(tag_file_path.stat().st_mtime)
-        if datetime.now() - last_modified_time < timedelta(days=args.continue_caption):
-            print(f"Skipping {tag_file_path} as it was modified within the last week.")
-            return None, None, 'skipped'   
+    if is_recently_captioned(image_path, args):
+        print(f"Skipping {tag_file_path} as it was modified within the last week.")
+        return folder_chartag, None, 'skipped'   
     try:
-        image = resize_image(image_path)
-        if image.mode != "RGB":
-            image = image.convert("RGB")
+        precomputed = precomputed or {}
+        views = precomputed.get('views')
+        if views is None:
+            with profiler.stage('decode'):
+                views = ImageViews(resize_image(image_path))
+        image = views.image
 
         # 使用 imgutils 獲取圖片等級
-        rating, features, chars = get_wd14_tags(image, character_threshold=0.6, general_threshold=0.2682, drop_overlap=True)
+        if 'wd14' in precomputed:
+            rating, features, chars = precomputed['wd14']
+        else:
+            with profiler.stage('wd14'):
+                rating, features, chars = get_wd14_tags(image, character_threshold=wd14_character_threshold, general_threshold=wd14_general_threshold, drop_overlap=True)
         features, keeptag = process_features(features)
         #features = drop_basic_character_tags(features)
         wd14_caption = tags_to_text(features, use_escape=False, use_spaces=True)
         special_text, chartags, boorutag, artisttag = generate_special_text(image_path, args, features, chars)
         ratingtag = max(rating, key=rating.get)
         wd14_caption = wd14_caption + ', ' + boorutag
-        more_detailed_caption, _ = run_example('<MORE_DETAILED_CAPTION>', image) 
+        more_detailed_caption = precomputed.get('caption')
+        if args.skip_florence:
+            more_detailed_caption = ''
+        elif more_detailed_caption is None:
+            more_detailed_caption, _ = run_example('<MORE_DETAILED_CAPTION>', views) 
         clip_caption = []
-        clip_caption, final_score, clothtag, persontag, peopletag, custom_keeptag, image_info = calculate_best_labels(image, wd14_caption, more_detailed_caption, image_path)
+        with profiler.stage('label_selection'):
+            clip_caption, final_score, clothtag, persontag, peopletag, custom_keeptag, image_info = calculate_best_labels(views, wd14_caption, more_detailed_caption, image_path, args, precomputed.get('clip_features'))
         florence_caption =', '.join([label.lower() for label in more_detailed_caption.split(", ") if label.strip() and '"' not in label and not any(char.isupper() for char in label[1:])])
-        aestag = get_aesthetic_tag(image)
-        folder_chartag = build_folder_chartag(clip_caption[4], folder_chartag) 
+        if args.skip_aesthetic:
+            aestag = ''
+        else:
+            aestag = precomputed.get('aestag') or get_aesthetic_tag(views)
+        folder_chartag = build_folder_chartag(clip_caption[4], folder_chartag, chartags) 
         if persontag:
             special_text = f"{persontag} " + special_text
         if args.not_char:
@@ -552,135 +1619,298 @@ def process_image(image_path, folder_chartag, args):
             tags_text =(
                 f"{special_text}, ___{clip_caption[4]}"
             )            
-        with open(tag_file_path, 'w', encoding='utf-8') as f:
-            f.write(tags_text.lower()) 
+        if manifest is not None:
+            manifest.update(image_path, tags_text.lower(), final_score, clip_caption[4], chartags, image_info)
+        if captions is not None:
+            captions[image_path] = tags_text.lower()
+        else:
+            with profiler.stage('write'), open(tag_file_path, 'w', encoding='utf-8') as f:
+                f.write(tags_text.lower()) 
         return folder_chartag, final_score, image_info
     except Exception as e:
         print(f"Failed to process image {image_path}: {e}")
         traceback.print_exc()
 
-def drop_chartags_in_folder(folder_path, folder_chartag):
+def drop_tags_from_caption(tags_text, tags_to_drop):
+    """
+    從每一行標籤中刪除 tags_to_drop 的標籤
+    """
+    lines = tags_text.split('\n')
+    for i, line in enumerate(lines):
+        new_content = []
+        tags = [tag.strip() for tag in line.split(',')]
+        for tag in tags:
+            if tag and tag not in tags_to_drop:
+                new_content.append(tag)
+        lines[i] = ', '.join(new_content)
+    return '\n'.join(lines)
+
+def chartags_to_drop(folder_chartag):
     """
-    在指定目录中删除高频chartag
-    输入: 目录路径folder_path, folder_chartag字典
+    找出資料夾中的高频chartag
+    输入: folder_chartag字典
     """
     max_count = max(folder_chartag.values())    
     threshold = max_count / 3
-    tags_to_drop = {tag for tag, count in folder_chartag.items() if count > threshold}
-    
-    # 遍历目录中的每个txt文件
-    for filename in os.listdir(folder_path):
-        if filename.endswith('.txt'):
-            file_path = os.path.join(folder_path, filename)
-            with open(file_path, 'r', encoding='utf-8') as file:
-                lines = file.readlines()
-            
-            for i, line in enumerate(lines):
-                new_content = []
-                tags = [tag.strip() for tag in line.split(',')]
-                for tag in tags:
-                    if tag and tag not in tags_to_drop:
-                        new_content.append(tag)
-                lines[i] = ', '.join(new_content)
-            
-            with open(file_path, 'w', encoding='utf-8') as file:
-                file.write('\n'.join(lines))
+    return {tag for tag, count in folder_chartag.items() if count > threshold}
 
-def drop_features_in_folder(root, image_infos_list, drop_percent = 0.3):
-    # 合并所有的 image_features
-    combined_image_features = torch.cat([info[1] for info in image_infos_list]).mean(dim=0, keepdim=True)
-    combined_image_features = F.normalize(combined_image_features, dim=-1)
+class FolderLabelStats:
+    """
+    資料夾層級自動刪標需要的統計：圖片特徵的累加和、圖片數與標籤出現次數，邊打標邊更新，
+    記憶體只和標籤種類數有關，和圖片數無關。
+    """
+    def __init__(self):
+        self.feature_sum = None
+        self.image_count = 0
+        self.label_counts = Counter()
 
-    for image_info in image_infos_list:
-        image_path, _, labels = image_info
-        final_labels = {}
+    def add(self, image_features, labels):
+        image_features = np.asarray(image_features, dtype=np.float64).reshape(-1)
+        if self.feature_sum is None:
+            self.feature_sum = image_features.copy()
+        else:
+            self.feature_sum += image_features
+        self.image_count += 1
+        self.label_counts.update(labels)
 
-    all_labels_list = [label for info in image_infos_list for label in info[2]]
-    all_labels = set(all_labels_list)
-    final_labels = {}
+    def mean_features(self):
+        return self.feature_sum / self.image_count
 
-    for label in all_labels:
-        with torch.no_grad():
-            logits_per_image = (combined_image_features @ text_features_dict[label].T).item()
-            final_labels[label] = logits_per_image
+def features_to_drop(folder_stats, drop_percent = 0.3):
+    """
+    找出和整個資料夾平均圖像特徵最接近、且出現在超過一成圖片中的標籤
+    """
+    # 合并所有的 image_features
+    combined_image_features = torch.from_numpy(folder_stats.mean_features()).view(1, -1)
+    combined_image_features = F.normalize(combined_image_features, dim=-1).to(device=device, dtype=clip_dtype)
 
-    sorted_labels = sorted(final_labels.items(), key=lambda item: item[1], reverse=True)
-    top_percent_index = max(1, int(len(sorted_labels) * drop_percent))
+    label_counts = folder_stats.label_counts
+    all_labels = list(label_counts)
+    # 沿用 manifest 的圖片不會在這次執行中編碼過標籤，score_labels 會補編碼
+    label_scores = score_labels(combined_image_features, all_labels)
+    sorted_indices = np.argsort(-label_scores, kind='stable')
+    top_percent_index = max(1, int(len(all_labels) * drop_percent))
+    min_count = folder_stats.image_count * 0.1
     
-    tags_to_drop = {label.replace(lebel_word, '').replace(clip_word, '') for label, _ in sorted_labels[:top_percent_index] if all_labels_list.count(label) > len(image_path) * 0.1}
+    tags_to_drop = {
+        all_labels[i].replace(lebel_word, '').replace(clip_word, '')
+        for i in sorted_indices[:top_percent_index]
+        if label_counts[all_labels[i]] > min_count
+    }
     print(tags_to_drop)
-    for image_info in image_infos_list:
-        image_path, _, labels = image_info
+    return tags_to_drop
 
-        file_path = Path(image_path).with_suffix('.txt')
-        if file_path.exists():
-            with open(file_path, 'r', encoding='utf-8') as file:
-                lines = file.readlines()
+class P2Quantile:
+    """
+    P² 演算法：不保存樣本，用五個標記線上估計單一分位數。
+    """
+    def __init__(self, q):
+        self.q = q
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+        self.increments = [0, q / 2, q, (1 + q) / 2, 1]
 
-            for i, line in enumerate(lines):
-                new_content = []
-                tags = [tag.strip() for tag in line.split(',')]
-                for tag in tags:
-                    if tag and tag not in tags_to_drop:
-                        new_content.append(tag)
-                lines[i] = ', '.join(new_content)
-            
-            with open(file_path, 'w', encoding='utf-8') as file:
-                file.write('\n'.join(lines))
+    def add(self, x):
+        h, n = self.heights, self.positions
+        if len(h) < 5:
+            h.append(x)
+            h.sort()
+            return
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if h[i] <= x < h[i + 1])
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not h[i - 1] < height < h[i + 1]:
+                    height = h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+                h[i] = height
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        h, n = self.heights, self.positions
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self):
+        if len(self.heights) < 5:
+            return self.heights[round(self.q * (len(self.heights) - 1))] if self.heights else None
+        return self.heights[2]
+
+class ScoreStats:
+    """
+    線上追蹤 final_score 的分布 (最小、最大值和分位數)。
+    樣本數少時保留原始分數算精確分位數，超過 exact_limit 後只用 P² 估計，記憶體固定。
+    """
+    def __init__(self, quantiles=(0.2, 0.4), exact_limit=1024):
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.sketches = {q: P2Quantile(q) for q in quantiles}
+        self.exact_limit = exact_limit
+        self.samples = []
+
+    def add(self, score):
+        self.count += 1
+        self.min = min(self.min, score)
+        self.max = max(self.max, score)
+        for sketch in self.sketches.values():
+            sketch.add(score)
+        if self.samples is not None:
+            self.samples.append(score)
+            if len(self.samples) > self.exact_limit:
+                self.samples = None
+
+    def quantile(self, q):
+        if self.samples is not None:
+            return float(np.quantile(self.samples, q))
+        return self.sketches[q].value()
+
+    def accuracy_cutoffs(self, mode='minmax'):
+        """
+        返回 (mess 門檻, low accuracy 門檻)，分數低於門檻就加上對應的標。
+        minmax 依最小最大值的 20% / 40%，percentile 依分數分布的第 20 / 40 百分位。
+        """
+        if self.count == 0 or self.max == self.min:
+            return None
+        if mode == 'percentile':
+            return self.quantile(0.2), self.quantile(0.4)
+        return self.min + 0.2 * (self.max - self.min), self.min + 0.4 * (self.max - self.min)
+
+def accuracy_tag_for(final_score, cutoffs):
+    if cutoffs is None:
+        return ""
+    mess_cutoff, low_cutoff = cutoffs
+    if final_score >= low_cutoff:
+        return ""
+    elif final_score >= mess_cutoff:
+        return "low accuracy."
+    else:
+        return "mess."
 
 def find_and_process_images(directory, args):
+    """
+    每張圖的標籤一打完就連同分數寫進暫存的 spill 檔，資料夾只保留 FolderLabelStats 的統計，記憶體不隨圖片數增加。
+    每個資料夾處理完就讀回該資料夾的 spill 套用刪標寫成 txt，並存一次 manifest，中途中斷時已完成的資料夾不會白跑 (--continue_caption、--incremental 可接續)。
+    分數分布同時線上統計，accuracy 標的門檻要全部資料夾處理完才確定，最後再讀一次 spill 補上 accuracy 標，內容沒變的 txt 不重寫。
+    """
     directory = directory.replace('\\', '/')
     extensions = ["*.jpg", "*.png", "*.jpeg", "*.webp", "*.bmp"]
-    all_final_scores = []
+    score_stats = ScoreStats()
+    folder_drops = []
+    manifest = CaptionManifest(directory, args) if args.incremental else None
+    spill_file = tempfile.TemporaryFile('w+', encoding='utf-8')
+    write_queue = queue.Queue(maxsize=args.write_queue_depth)
+    writer = threading.Thread(target=caption_writer, args=(write_queue,), daemon=True)
+    writer.start()
+
+    def spill(image_path, tags_text, final_score):
+        score_stats.add(final_score)
+        spill_file.write(json.dumps([image_path, tags_text, final_score, len(folder_drops)], ensure_ascii=False) + '\n')
+
+    def read_spill(start=0):
+        spill_file.seek(start)
+        for line in spill_file:
+            image_path, tags_text, final_score, folder_index = json.loads(line)
+            if folder_drops[folder_index]:
+                tags_text = drop_tags_from_caption(tags_text, folder_drops[folder_index])
+            yield image_path, tags_text, final_score
+
+    def caption_path(image_path):
+        return Path(image_path).with_suffix('').with_suffix('.txt')
+
     for root, dirs, files in os.walk(directory):
         folder_chartag = {}
         image_paths = []
-        image_infos_list = []
+        captions = {}
         for ext in extensions:
             for file in files:
                 if fnmatch.fnmatchcase(file, ext) or fnmatch.fnmatchcase(file, ext.upper()):
                     image_paths.append(os.path.join(root, file))
 
-        for image_path in tqdm(image_paths, desc=f"處理圖片 {root}"):
+        if not image_paths:
+            continue
+        feature_store = ImageFeatureStore(root)
+        folder_stats = FolderLabelStats()
+        spill_file.seek(0, os.SEEK_END)
+        folder_start = spill_file.tell()
+
+        # 內容和參數都沒變的圖片直接沿用 manifest 的結果，從資料夾層級處理前的原始標籤重新套用，特徵沿用 feature_store 的
+        pending_paths = []
+        for image_path in image_paths:
+            entry = manifest.lookup(image_path) if manifest else None
+            image_features = feature_store.carry(image_path) if entry is not None else None
+            if image_features is None:
+                pending_paths.append(image_path)
+                continue
+            folder_chartag = build_folder_chartag(entry['chartag_text'], folder_chartag, entry['chartags'])
+            folder_stats.add(image_features, entry['labels'])
+            spill(image_path, entry['tags_text'], entry['final_score'])
+        if manifest and len(pending_paths) < len(image_paths):
+            print(f"{root}: {len(image_paths) - len(pending_paths)} 張圖片沿用 manifest 結果")
+
+        for image_path, precomputed in tqdm(iter_preprocessed(pending_paths, args), total=len(pending_paths), desc=f"處理圖片 {root}"):
             try:
-                folder_chartag, final_score, image_info = process_image(image_path, folder_chartag, args)  
-                all_final_scores.append((image_path, final_score))
-                image_infos_list.append(image_info)
+                folder_chartag, final_score, image_info = process_image(image_path, folder_chartag, args, precomputed, captions, manifest)  
+                if final_score is None:
+                    # 略過的圖片保留上次的特徵
+                    feature_store.carry(image_path)
+                    continue
+                folder_stats.add(feature_store.add(image_path, image_info[1]), image_info[2])
+                spill(image_path, captions.pop(image_path), final_score)
             except Exception as e:
+                captions.pop(image_path, None)
                 print(f"Failed to process image {image_path}: {e}")
                 traceback.print_exc()
                 
-        if args.drop_chartag and folder_chartag:
-            drop_chartags_in_folder(root, folder_chartag)
+        feature_store.finish()
+        with profiler.stage('folder_drop', folder_stats.image_count):
+            tags_to_drop = set()
+            if args.drop_chartag and folder_chartag:
+                tags_to_drop |= chartags_to_drop(folder_chartag)
 
-        if image_infos_list and args.autodroptag !=0:
-            drop_features_in_folder(root, image_infos_list, args.autodroptag)
-            
-    if all_final_scores:
-        max_score = max(all_final_scores, key=lambda x: x[1])[1]
-        min_score = min(all_final_scores, key=lambda x: x[1])[1]
-
-        # 添加accuracy_tag到每个对应的txt文件
-        for image_path, final_score in all_final_scores:
-            relative_score = (final_score - min_score) / (max_score - min_score)
-            if relative_score >= 0.4:
-                accuracy_tag = ""
-            elif relative_score >= 0.2:
-                accuracy_tag = "low accuracy."
-            else:
-                accuracy_tag = "mess."
-            
-            tag_file_path = Path(image_path).with_suffix('').with_suffix('.txt')
-            if tag_file_path.exists():
-                with open(tag_file_path, 'r', encoding='utf-8') as file:
-                    content = file.read()
-                if accuracy_tag:
-                    content = content.replace('___', f'{accuracy_tag}, ___') 
-                    # 将修改后的内容写回文件
-                    with open(tag_file_path, 'w', encoding='utf-8') as file:
-                        file.write(content)
+            if folder_stats.image_count and args.autodroptag !=0:
+                tags_to_drop |= features_to_drop(folder_stats, args.autodroptag)
+        folder_drops.append(tags_to_drop)
+
+        # 先寫不含 accuracy 標的 txt；上次執行已帶 accuracy 標的檔案留到最後一次決定，免得同一檔案寫兩次
+        for image_path, tags_text, final_score in read_spill(folder_start):
+            current_texts = (tags_text,) + tuple(tags_text.replace('___', f'{accuracy_tag}, ___') for accuracy_tag in ("low accuracy.", "mess.") if '___' in tags_text)
+            write_queue.put((caption_path(image_path), tags_text, current_texts))
+        write_queue.join()
+        if manifest:
+            manifest.save()
+
+    if manifest:
+        manifest.save(prune=True)
+
+    # 添加accuracy_tag到每个对应的txt文件，內容沒變的不重寫
+    cutoffs = score_stats.accuracy_cutoffs(args.accuracy_cutoff)
+    for image_path, tags_text, final_score in read_spill():
+        if final_score is not None:
+            accuracy_tag = accuracy_tag_for(final_score, cutoffs)
+            if accuracy_tag:
+                tags_text = tags_text.replace('___', f'{accuracy_tag}, ___') 
+        write_queue.put((caption_path(image_path), tags_text, None))
+    write_queue.put(None)
+    writer.join()
+    spill_file.close()
         
-if __name__ == "__main__":
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="圖片標籤處理腳本")
     parser.add_argument("--folder_name", action="store_true", help="使用目錄名當作角色名")
     parser.add_argument("--drop_chartag", action="store_true", help="自動刪除角色特徵標籤")
@@ -694,17 +1924,88 @@ if __name__ == "__main__":
     parser.add_argument("--continue_caption", type=int, default=0, help="忽略n天內打的標")
     parser.add_argument("--clustertag", action="store_true", help="對標籤聚類")
     parser.add_argument("--autodroptag", type=float, default=0, help="自動刪標，刪除跟資料集太接近的標，小數點是比例")
-    parser.add_argument("directory", type=str, help="處理目錄地址")
-    args = parser.parse_args()
+    parser.add_argument("--incremental", action="store_true", help="依圖片內容雜湊只處理新增或修改過的圖片，結果記在資料集根目錄的 .caption_manifest.json")
+    parser.add_argument("--accuracy_cutoff", choices=["minmax", "percentile"], default="minmax", help="accuracy 標的門檻：minmax 依分數範圍的 20%%/40%%，percentile 依分數分布的第 20/40 百分位")
+    parser.add_argument("--skip_florence", action="store_true", help="不跑 Florence-2 自然語言標")
+    parser.add_argument("--skip_aesthetic", action="store_true", help="不跑美學模型")
+    parser.add_argument("--caption_batch_size", type=int, default=1, help="Florence-2 每批次打標圖片數")
+    parser.add_argument("--wd14_batch_size", type=int, default=1, help="WD14 tagger 每批次圖片數")
+    parser.add_argument("--aes_batch_size", type=int, default=1, help="美學模型每批次圖片數")
+    parser.add_argument("--clip_batch_size", type=int, default=1, help="LongCLIP 圖片編碼每批次圖片數")
+    parser.add_argument("--decode_workers", type=int, default=4, help="讀圖縮圖執行緒數")
+    parser.add_argument("--decode_queue_depth", type=int, default=32, help="讀圖 stage 佇列長度")
+    parser.add_argument("--model_queue_depth", type=int, default=32, help="模型 stage 佇列長度")
+    parser.add_argument("--write_queue_depth", type=int, default=64, help="寫檔 stage 佇列長度")
+    parser.add_argument("--text_batch_size", type=int, default=64, help="clothtag/peopletag/custom_keeptag 候選句每批編碼數")
+    parser.add_argument("--unordered_pairs", action="store_true", help="候選標籤組合不分先後，只算一半組合，更快但結果可能略有不同")
+    parser.add_argument("--text_cache_dir", type=str, default="./checkpoints/text_features_cache", help="LongCLIP 文字特徵快取目錄，空字串停用")
+    parser.add_argument("--profile", type=str, default=None, help="把各 stage 的耗時、每秒張數與記憶體高點寫成 JSON 檔")
+    parser.add_argument("--trace", type=str, default=None, help="把各 stage 的時間軸寫成 Chrome trace 檔 (chrome://tracing 或 Perfetto 開啟)")
+    parser.add_argument("--serve", action="store_true", help="常駐模式，模型只載入一次，從本機 socket 接收任務")
+    parser.add_argument("--port", type=int, default=worker_port, help="常駐模式監聽的本機埠號")
+    parser.add_argument("directory", type=str, nargs="?", help="處理目錄地址")
+    args = parser.parse_args(argv)
+    if not args.serve and not args.directory:
+        parser.error("需要處理目錄地址")
     if args.not_char:
         args.folder_name = True
-        
-    clip_labels = [f"{clip_word}{label}" for label in clip_labels]
-    for label in clip_labels + view_labels:
-        if label not in text_features_dict:
-            text_tensor = longclip.tokenize([label]).to(device)
-            with torch.no_grad():
-                text_features = clip_model.encode_text(text_tensor)
-                text_features = F.normalize(text_features, dim=-1)
-            text_features_dict[label] = text_features
-    find_and_process_images(args.directory, args)
+    return args
+
+def run_job(args):
+    """
+    處理一個資料夾任務，結束時把新的文字特徵寫回快取，有指定 --profile/--trace 時輸出各 stage 統計。
+    """
+    profiler.reset(enabled=bool(args.profile or args.trace))
+    if args.text_cache_dir:
+        text_features_dict.open(args.text_cache_dir, clip_checkpoint)
+    try:
+        find_and_process_images(args.directory, args)
+    finally:
+        text_features_dict.save()
+        if profiler.enabled:
+            profiler.write(args.profile, args.trace)
+            profiler.reset()
+
+class CaptionJobHandler(socketserver.StreamRequestHandler):
+    """
+    每個連線是一個任務：一行 JSON {"argv": [...]}，處理完回傳一行 JSON {"status": "done"} 或 {"status": "error", "message": ...}。
+    """
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline().decode('utf-8'))
+            job_args = parse_args(job['argv'])
+            print(f"收到任務: {job_args.directory}")
+            run_job(job_args)
+            response = {'status': 'done'}
+        except SystemExit:
+            response = {'status': 'error', 'message': f"參數錯誤: {job.get('argv')}"}
+        except Exception as e:
+            traceback.print_exc()
+            response = {'status': 'error', 'message': str(e)}
+        self.wfile.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
+
+def serve(port):
+    """
+    常駐模式：模型第一次用到後一直留在記憶體，任務依序處理。只監聽 127.0.0.1。
+    """
+    with socketserver.TCPServer(('127.0.0.1', port), CaptionJobHandler) as server:
+        print(f"caption worker 監聽 127.0.0.1:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+def prefix_clip_labels():
+    """
+    clip_labels 加上 clip_word 前綴後才拿去算 clip 分數，__main__ 和 benchmark.py 都在執行前呼叫一次，重複呼叫不會重複加
+    """
+    global clip_labels
+    clip_labels = [label if label.startswith(clip_word) else f"{clip_word}{label}" for label in clip_labels]
+
+if __name__ == "__main__":
+    args = parse_args()
+    prefix_clip_labels()
+    if args.serve:
+        serve(args.port)
+    else:
+        run_job(args)
@@ -46,7 +46,8 @@ def install_packages(venv_name='venv'):
         'timm',
         'aesthetic-predictor-v2-5',
         'requests',
-        'faiss-cpu'
+        'faiss-cpu',
+        'psutil'
     ]
 
     # 安装 PyTorch 和 torchvision
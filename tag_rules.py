@@ -0,0 +1,50 @@
+import re
+from typing import Dict, Iterable, List
+
+
+class TagRules:
+    """
+    預先編譯的標籤規則。
+    形如 ^literal$ 的規則放進集合做精確比對，其餘規則合併成一個交替式正則只編譯一次，
+    每個標籤字串的比對結果會記住，同一個標籤不會重複比對。
+    """
+    def __init__(self, patterns: Iterable[str], flags: int = 0):
+        self.patterns: List[str] = list(patterns)
+        self.flags = flags
+        self.exact_tags = set()
+        regex_patterns = []
+        for pattern in self.patterns:
+            literal = self._literal(pattern)
+            if literal is not None and not flags & re.IGNORECASE:
+                self.exact_tags.add(literal)
+            else:
+                regex_patterns.append(pattern)
+        self.regex = re.compile('|'.join(f'(?:{pattern})' for pattern in regex_patterns), flags) if regex_patterns else None
+        self._cache: Dict[str, bool] = {}
+
+    @staticmethod
+    def _literal(pattern: str):
+        """
+        ^abc$ 這種只有文字、底線和空白的規則返回 abc，否則返回 None
+        """
+        match = re.fullmatch(r'\^([\w ]+)\$', pattern)
+        return match.group(1) if match else None
+
+    def extend(self, patterns: Iterable[str]) -> 'TagRules':
+        return TagRules(self.patterns + list(patterns), self.flags)
+
+    def matches(self, tag: str) -> bool:
+        """
+        整個標籤是否符合任一規則 (re.match 語意)，結果依標籤字串快取
+        """
+        result = self._cache.get(tag)
+        if result is None:
+            result = tag in self.exact_tags or (self.regex is not None and self.regex.match(tag) is not None)
+            self._cache[tag] = result
+        return result
+
+    def search(self, text: str) -> bool:
+        """
+        一段文字中是否出現任一規則 (re.search 語意)，不快取
+        """
+        return text in self.exact_tags or (self.regex is not None and self.regex.search(text) is not None)